@@ -8,11 +8,16 @@ but if we want to distribute it we  want to minimize external dependencies
 we may want to do something simpler....
 """ 
 import types
-import string
+import array
+try:
+    import numpy
+except ImportError:
+    numpy=None
 
 class GCPD_No_Data(ValueError): pass
 class StarNameException(ValueError): pass
 class ParseError(Exception): pass
+class DerivationError(ValueError): pass
 
 def to_float(str):
     """ Helper function for parsing data with some data omitted
@@ -67,10 +72,13 @@ def safe_sub(fl,st):
 
 def add_list(l1,l2):
     """Helper function for parsing data with some data omitted.
+    Float arrays, see to_array, are added as arrays.
     >>> add_list([1,'4.56', '*'], ['-1', '100', '1000']) #doctest: +NORMALIZE_WHITESPACE
     [0.0, 104.56, '']
 
     """
+    if is_array(l1) or is_array(l2):
+        return to_array(l1)+to_array(l2)
     r=[]
     for x1,x2 in zip(l1,l2):
         try:
@@ -84,11 +92,14 @@ def add_list(l1,l2):
 
 def sub_list(l1,l2):
     """Helper function for parsing data with some data omitted.
+    Float arrays, see to_array, are subtracted as arrays.
     >>> sub_list([1,'4.75', '*'], ['-1', 1, '1000']) #doctest: +NORMALIZE_WHITESPACE
     [2.0, 3.75, '']
 
 
     """
+    if is_array(l1) or is_array(l2):
+        return to_array(l1)-to_array(l2)
     r=[]
     for x1,x2 in zip(l1,l2):
         try:
@@ -100,6 +111,185 @@ def sub_list(l1,l2):
             r.append('')
     return r
 
+def float_list(l):
+    """Helper function for parsing data with some data omitted.
+    Float arrays are returned as they are.
+    >>> float_list(['1.5', ' ', '*'])
+    [1.5, '', '']
+
+    """
+    if is_array(l):
+        return l
+    return [to_float(x) for x in l]
+
+def fill_list(l1,l2):
+    """Helper function for parsing data with some data omitted.
+    Omitted values of l1 are taken from l2.
+    >>> fill_list([1.0, '', ''], ['5', '2.5', ' '])
+    [1.0, 2.5, '']
+
+    """
+    if is_array(l1) or is_array(l2):
+        l1=to_array(l1)
+        return numpy.where(numpy.isnan(l1), to_array(l2), l1)
+    r=[]
+    for x1,x2 in zip(l1,l2):
+        if x1=='':
+            r.append(to_float(x2))
+        else:
+            r.append(x1)
+    return r
+
+def is_array(l):
+    return numpy is not None and isinstance(l, numpy.ndarray)
+
+def to_array(l):
+    """ Float array of a column, with NaN where to_float gives ''.
+    Needs numpy.
+    """
+    if is_array(l) and l.dtype.kind=='f':
+        return l
+    try:
+        return numpy.array(l, dtype=float)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return numpy.array([x.strip() or 'nan' for x in l], dtype=float)
+    except (ValueError, AttributeError):
+        # something float() does not take, like '*'
+        return numpy.array([x=='' and numpy.nan or x
+                            for x in [to_float(y) for y in l]], dtype=float)
+
+def array_columns(d):
+    """ Columns of parse_data as float arrays, see to_array """
+    return dict([(k,to_array(v)) for k,v in d.items()])
+
+def list_columns(d):
+    """ Float arrays back to lists, with '' for NaN """
+    r={}
+    for k,v in d.items():
+        if is_array(v):
+            v=[x if x==x else '' for x in v.tolist()]
+        r[k]=v
+    return r
+
+def parse_table(column_names,lines,delimiter='\t'):
+    """ Columns of a photoSys.cgi table as a dict of tuples, keyed by
+    the stripped column names; columns without a name are left out.
+    Rows are split and transposed in one pass, short rows are padded
+    with ''. With delimiter None rows are split on whitespace, which
+    drops the empty field before the leading separator, so the empty
+    first column name is dropped as well.
+
+    >>> sorted(parse_table(['', 'V', 'B-V'], ['\\t6.38\\t1.57', '\\t6.5']).items())
+    [('B-V', ('1.57', '')), ('V', ('6.38', '6.5'))]
+    >>> sorted(parse_table(['', '7460', 'Ref'], ['  4.15  1', '  4.25  2'], None).items())
+    [('7460', ('4.15', '4.25')), ('Ref', ('1', '2'))]
+    """
+    if delimiter is None and column_names and not column_names[0].strip():
+        column_names=column_names[1:]
+    width=len(column_names)
+    pad=['']*width
+    rows=[]
+    for l in lines:
+        row=l.split(delimiter)
+        if len(row)<width:
+            row.extend(pad[len(row):])
+        rows.append(row)
+    columns=zip(*rows) or [()]*width
+    d={}
+    for n,column in zip(column_names,columns):
+        n=n.strip()
+        if n:
+            d[n]=column
+    return d
+
+class GCPD_measurements(object):
+    """ Magnitudes of one target in one photometric system.
+    Every band is a packed array('d') column with an array('b')
+    validity mask, omitted values are stored as 0.0 and are not valid.
+    Row i of every column comes from the same line of the table.
+
+    >>> m=GCPD_measurements('HD1', 'UBV', 'Johnson',
+    ...                     [('V', [6.5, '']), ('B', ['', 7.25])])
+    >>> list(m)
+    [('V', 6.5), ('B', 7.25)]
+    >>> m.column('B')
+    [None, 7.25]
+    >>> len(m)
+    2
+    """
+    __slots__=('target','system','common_name','bands','values','masks',
+               'references','rem')
+
+    def __init__(self,target,system,common_name,columns,references=(),
+                 rem=''):
+        """ columns is a list of (band, column) in band order, a
+        column is a list of floats and '', or a float array with NaN
+        for omitted values, as process_data gives them.
+        """
+        self.target=target
+        self.rem=rem
+        self.system=system
+        self.common_name=common_name
+        self.bands=[]
+        self.values={}
+        self.masks={}
+        self.references=[dict(r) for r in references]
+        for band,column in columns:
+            if is_array(column):
+                valid=~numpy.isnan(column)
+                values=array.array('d',
+                                   numpy.where(valid,column,0.0).tostring())
+                mask=array.array('b', valid.astype('b').tostring())
+            else:
+                values=array.array('d')
+                mask=array.array('b')
+                for x in column:
+                    if type(x)==types.FloatType:
+                        values.append(x)
+                        mask.append(1)
+                    else:
+                        values.append(0.0)
+                        mask.append(0)
+            self.bands.append(band)
+            self.values[band]=values
+            self.masks[band]=mask
+
+    def __iter__(self):
+        """ (band, value) of all valid values, band by band """
+        for band in self.bands:
+            for value,valid in itertools.izip(self.values[band],
+                                              self.masks[band]):
+                if valid:
+                    yield band,value
+
+    def __len__(self):
+        return sum([self.masks[band].count(1) for band in self.bands])
+
+    def records(self):
+        """ GCPD_measurement records of the valid values, then a
+        GCPD_reference record for each reference.
+        """
+        system=translate_photo_name(self.system)
+        for band,value in self:
+            yield GCPD_measurement(self.target,system,band,value)
+        for record in self.reference_records():
+            yield record
+
+    def reference_records(self):
+        """ GCPD_reference records of the references """
+        system=translate_photo_name(self.system)
+        return [GCPD_reference(self.target,system,ref.get('Author'),
+                               ref.get('Journal'),ref.get('Title'),
+                               ref.get('BibcodeURL'))
+                for ref in self.references]
+
+    def column(self,band):
+        """ Values of band, None where omitted """
+        return [value if valid else None for value,valid in
+                itertools.izip(self.values[band], self.masks[band])]
+
 
 def translate_name(starname):
     """ Here is translation definition:
@@ -138,15 +328,1571 @@ def translate_name(starname):
         return starname # may be it is ok?
         
 
-import urllib, sys,htmllib,formatter,re
+import urllib, sys,re,htmlentitydefs
 import getopt
+import httplib, urlparse, socket, threading, Queue, collections, itertools
+import asyncore, heapq, cStringIO, traceback, multiprocessing
+import sqlite3, time, zlib, json, csv, os, mmap, struct, hashlib, random
+
+# Names of some bright stars, one star per line: the name giving its
+# GCPD star number first, then HR, HIP and SAO numbers, proper name,
+# Bayer and Flamsteed designations.
+bright_star_aliases="""
+HD48915	HR2491	HIP32349	SAO151881	Sirius	alf CMa	9 CMa
+HD45348	HR2326	HIP30438	SAO234480	Canopus	alf Car
+HD124897	HR5340	HIP69673	SAO100944	Arcturus	alf Boo	16 Boo
+HD172167	HR7001	HIP91262	SAO67174	Vega	alf Lyr	3 Lyr
+HD34029	HR1708	HIP24608	SAO40186	Capella	alf Aur	13 Aur
+HD34085	HR1713	HIP24436	SAO131907	Rigel	bet Ori	19 Ori
+HD61421	HR2943	HIP37279	SAO115756	Procyon	alf CMi	10 CMi
+HD39801	HR2061	HIP27989	SAO113271	Betelgeuse	alf Ori	58 Ori
+HD187642	HR7557	HIP97649	SAO125122	Altair	alf Aql	53 Aql
+HD29139	HR1457	HIP21421	SAO94027	Aldebaran	alf Tau	87 Tau
+HD116658	HR5056	HIP65474	SAO157923	Spica	alf Vir	67 Vir
+HD148478	HR6134	HIP80763	SAO184415	Antares	alf Sco	21 Sco
+HD87901	HR3982	HIP49669	SAO98967	Regulus	alf Leo	32 Leo
+HD197345	HR7924	HIP102098	SAO49337	Deneb	alf Cyg	50 Cyg
+HD8890	HR424	HIP11767	SAO308	Polaris	alf UMi	1 UMi
+"""
+
+_greek={'ALPHA':'ALF', 'BETA':'BET', 'GAMMA':'GAM', 'DELTA':'DEL',
+        'EPSILON':'EPS', 'ZETA':'ZET', 'THETA':'TET', 'IOTA':'IOT',
+        'KAPPA':'KAP', 'LAMBDA':'LAM', 'OMICRON':'OMI', 'SIGMA':'SIG',
+        'UPSILON':'UPS', 'OMEGA':'OME'}
+
+def alias_key(name):
+    """ Normalized star name: upper case, without blanks and leading
+    zeros, with Greek letters as their three letter abbreviations.
+
+    >>> alias_key('alpha  CMa'), alias_key('HR 0424')
+    ('ALFCMA', 'HR424')
+    """
+    words=re.findall('[A-Z]+|[0-9]+', name.upper())
+    return ''.join([_greek.get(w, w.isdigit() and str(int(w)) or w)
+                    for w in words])
+
+class GCPD_resolver:
+    """ Resolves star names to GCPD star codes through an alias table,
+    names missing from it go through translate_name. Tables have one
+    star per line, tab separated names, the first of which must be one
+    translate_name knows. Lines loaded later win.
+    The last max_codes resolved names are remembered, an arbitrary one
+    is forgotten to make room for a new one.
+
+    >>> r=GCPD_resolver()
+    >>> r.code('Sirius'), r.code('HIP 32349'), r.code('HD48915')
+    ('0100048915', '0100048915', '0100048915')
+    >>> r.code('HIP1'), r.code('Nova')
+    ('0160000001', 'Nova')
+    """
+    def __init__(self, table=bright_star_aliases, max_codes=10000):
+        self.aliases={}
+        self.codes={}
+        self.max_codes=max_codes
+        self.lock=threading.Lock()
+        self.load(table.split('\n'))
+
+    def load(self, lines):
+        """ Add the stars of a table, given as its lines """
+        aliases={}
+        for line in lines:
+            names=[n for n in line.rstrip('\r\n').split('\t') if n.strip()]
+            if not names or names[0].startswith('#'):
+                continue
+            code=translate_name(alias_key(names[0]))
+            if not is_star_code(code):
+                raise ValueError('no GCPD star number for %s' % names[0])
+            for name in names:
+                aliases[alias_key(name)]=code
+        with self.lock:
+            self.aliases.update(aliases)
+            self.codes.clear()
+
+    def code(self, starname):
+        """ GCPD star code of starname, starname itself if it has none """
+        code=self.codes.get(starname)
+        if code is None and is_star_code(starname):
+            return starname
+        if code is None:
+            key=alias_key(starname)
+            code=self.aliases.get(key)
+            if code is None:
+                code=translate_name(key)
+                if not is_star_code(code):
+                    code=starname
+            codes=self.codes
+            if len(codes)>=self.max_codes:
+                try:
+                    codes.popitem()
+                except KeyError:
+                    pass
+            codes[starname]=code
+        return code
+
+def is_star_code(code):
+    return len(code)==10 and code.isdigit()
+
+gcpd_resolver=GCPD_resolver()
+
+def star_code(starname):
+    """ GCPD star code of starname, see GCPD_resolver """
+    if gcpd_resolver is None:
+        return translate_name(starname)
+    return gcpd_resolver.code(starname)
+
+def unique_targets(targets, duplicate=None):
+    """ (target, rem) pairs of targets, without the ones naming a star
+    and rem code given before. duplicate(target, rem, first) is called
+    for these, first is the name the star was given first.
+    Every star and rem code given is remembered until targets ends,
+    so main only does this with --unique.
+
+    >>> list(unique_targets([('Vega', ''), ('HD 172167', ''), ('Vega', 'A')]))
+    [('Vega', ''), ('Vega', 'A')]
+    """
+    seen={}
+    for target,rem in targets:
+        key=(star_code(target), rem.strip())
+        if key in seen:
+            if duplicate is not None:
+                duplicate(target, rem, seen[key])
+            continue
+        seen[key]=target
+        yield target,rem
+
+
+def transient_error(e):
+    """ True for errors a query may get past by trying again:
+    timeouts, dropped connections and HTTP 429 and 5xx responses.
+
+    >>> transient_error(socket.timeout()), transient_error(IOError('http error', 503))
+    (True, True)
+    >>> transient_error(IOError('http error', 404))
+    False
+    """
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return True
+    return (isinstance(e, IOError) and len(e.args)>1 and
+            e.args[0]=='http error' and
+            (e.args[1]==429 or 500<=e.args[1]<600))
+
+def retry_after(e):
+    """ Seconds the Retry-After header of an HTTP error asks for """
+    try:
+        return float(e.args[3].getheader('retry-after'))
+    except (IndexError, AttributeError, TypeError, ValueError):
+        return 0.
+
+class GCPD_token_bucket:
+    """ Token bucket rate limit: take() blocks so that on average at
+    most rate calls per second return, with bursts of up to burst.
+
+    >>> b=GCPD_token_bucket(10, 2)
+    >>> [round(max(0, b.reserve()), 2) for i in range(4)]
+    [0.0, 0.0, 0.1, 0.2]
+    """
+    def __init__(self, rate, burst=None):
+        self.rate=float(rate)
+        self.burst=float(burst or max(rate, 1))
+        self.tokens=self.burst
+        self.time=time.time()
+        self.lock=threading.Lock()
+
+    def take(self):
+        wait=self.reserve()
+        if wait>0:
+            time.sleep(wait)
+
+    def reserve(self):
+        """ Takes a token, returns the seconds until it is there """
+        with self.lock:
+            now=time.time()
+            self.tokens=min(self.burst, self.tokens+(now-self.time)*self.rate)
+            self.time=now
+            # a token not there yet is reserved, so waiters keep their turn
+            self.tokens-=1
+            return -self.tokens/self.rate
+
+class GCPD_aimd_limiter:
+    """ Adaptive limit of concurrent requests, between minimum and
+    maximum. Every request that goes well raises the limit by
+    1/limit, about one per round of limit requests. A failed request,
+    or a mean latency over slow_factor times the best seen, halves
+    it, at most once per round. The best latency ages by 1% a
+    request, so it follows a server that gets slower for good.
+
+    >>> l=GCPD_aimd_limiter(4)
+    >>> for i in range(4): l.acquire()
+    >>> l.try_acquire()
+    False
+    >>> for i in range(4): l.release(1., failed=True)
+    >>> l.limit
+    2.0
+    >>> l.acquire(); l.release(1.)
+    >>> l.limit
+    2.5
+    >>> for i in range(3):
+    ...     l.acquire(); l.release(100.)
+    >>> l.limit
+    1.25
+    """
+    def __init__(self, maximum, minimum=1, slow_factor=3.):
+        self.minimum=minimum
+        self.maximum=maximum
+        self.limit=float(maximum)
+        self.slow_factor=slow_factor
+        self.inflight=0
+        self.latency=None   # exponential moving average
+        self.best=None
+        self.round=0        # requests since the last decrease
+        self.cond=threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight>=int(self.limit):
+                self.cond.wait()
+            self.inflight+=1
+
+    def try_acquire(self):
+        """ acquire, or False if that would have to wait """
+        with self.cond:
+            if self.inflight>=int(self.limit):
+                return False
+            self.inflight+=1
+            return True
+
+    def release(self, latency, failed=False):
+        with self.cond:
+            self.inflight-=1
+            self.round+=1
+            if not failed:
+                if self.best is None:
+                    self.best=self.latency=latency
+                self.latency=0.8*self.latency+0.2*latency
+                self.best=min(self.latency, self.best*1.01)
+            if failed or self.latency>self.slow_factor*self.best:
+                if self.round>=self.limit:
+                    self.limit=max(self.minimum, self.limit/2)
+                    self.round=0
+            else:
+                self.limit=min(self.maximum, self.limit+1/self.limit)
+            self.cond.notify_all()
+
+class GCPD_retry_policy:
+    """ Retries of queries failing with a transient_error, after a
+    jittered exponential backoff: retry n waits a random time of up to
+    backoff*2**n seconds, at most max_backoff, or as long as a
+    Retry-After header asks. Gives up after retries retries, or when
+    the wait would end more than deadline seconds after the first try,
+    raising the last error as an IOError.
+
+    >>> p=GCPD_retry_policy(retries=2, backoff=1., max_backoff=1.5)
+    >>> [0<=p.delay(socket.timeout(), n, time.time())<=min(2**n, 1.5)
+    ...  for n in range(2)]
+    [True, True]
+    >>> print p.delay(socket.timeout(), 2, time.time())
+    None
+    >>> print p.delay(IOError('http error', 404), 0, time.time())
+    None
+    >>> print p.delay(socket.timeout(), 0, time.time()-p.deadline)
+    None
+    >>> headers=httplib.HTTPMessage(cStringIO.StringIO('Retry-After: 30\\n'))
+    >>> p.delay(IOError('http error', 503, '', headers), 0, time.time())
+    30.0
+    """
+    def __init__(self, retries=4, backoff=1., max_backoff=60., deadline=600.):
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+        self.deadline=deadline
+
+    def delay(self, error, attempt, start):
+        """ Seconds to wait before trying again a query first tried at
+        start, whose try number attempt (from 0) failed with error.
+        None if it is not tried again.
+        """
+        delay=random.uniform(0, min(self.max_backoff,
+                                    self.backoff*2**attempt))
+        delay=max(delay, retry_after(error))
+        if (not transient_error(error) or attempt>=self.retries or
+            time.time()+delay-start>self.deadline):
+            return None
+        return delay
+
+    def call(self, func, *args):
+        start=time.time()
+        attempt=0
+        while True:
+            try:
+                return func(*args)
+            except (IOError, httplib.HTTPException):
+                error=sys.exc_info()
+                delay=self.delay(error[1], attempt, start)
+                if delay is None:
+                    error=query_error(error)
+                    raise error[0], error[1], error[2]
+                del error
+                time.sleep(delay)
+                attempt+=1
+
+def query_error(error):
+    """ The sys.exc_info() error of a query, an HTTPException turned
+    into an IOError, so it is reported like the other errors.
+    """
+    if isinstance(error[1], httplib.HTTPException):
+        return (IOError, IOError('http protocol error', repr(error[1])),
+                error[2])
+    return error
+
+gcpd_retry=GCPD_retry_policy()
+
+class _GCPD_deadline_socket(object):
+    """ Socket of a _GCPD_connection: each operation times out after
+    the timeout of the socket, or at the deadline of the connection
+    if that comes first, so a server sending a byte now and then
+    cannot hold a request past its deadline.
+    """
+    def __init__(self, sock, conn):
+        self.sock=sock
+        self.conn=conn
+
+    def arm(self):
+        timeout=self.conn.remaining()
+        if timeout is not None and timeout<=0:
+            raise socket.timeout('request deadline passed')
+        self.sock.settimeout(timeout)
+
+    def recv(self, *args):
+        self.arm()
+        return self.sock.recv(*args)
+
+    def recv_into(self, *args):
+        self.arm()
+        return self.sock.recv_into(*args)
+
+    def sendall(self, *args):
+        self.arm()
+        return self.sock.sendall(*args)
 
-class GCPD_table_parser(htmllib.HTMLParser):
+    def makefile(self, mode='r', bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class _GCPD_connection(httplib.HTTPConnection):
+    """ HTTPConnection whose requests end by their deadline, set
+    before each request as a time.time() value.
+    """
+    deadline=None
+
+    def remaining(self):
+        """ Timeout of the next socket operation """
+        if self.deadline is None:
+            return self.timeout
+        left=self.deadline-time.time()
+        if self.timeout is None:
+            return left
+        return min(self.timeout, left)
+
+    def connect(self):
+        timeout=self.remaining()
+        if timeout is not None and timeout<=0:
+            raise socket.timeout('request deadline passed')
+        self.sock=_GCPD_deadline_socket(
+            socket.create_connection((self.host,self.port), timeout,
+                                     self.source_address), self)
+
+class GCPD_connection_pool:
+    """ A bounded pool of keep-alive HTTP connections to one host.
+    At most maxsize connections are open at any time, get() blocks
+    until one is handed back with put().
+    """
+    def __init__(self, host, maxsize=4, timeout=None):
+        self.host=host
+        self.timeout=timeout
+        self.idle=[]
+        self.lock=threading.Lock()
+        self.slots=threading.BoundedSemaphore(maxsize)
+
+    def get(self):
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return _GCPD_connection(self.host, timeout=self.timeout)
+
+    def put(self, conn, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+class GCPD_response:
+    """ File-like response; close() hands the connection back to its pool.
+    A connection is only reused if the whole response body was read,
+    a rest of known length up to drain_limit is read on close.
+    """
+    drain_limit=16384
+    def __init__(self, pool, conn, response):
+        self.pool=pool
+        self.conn=conn
+        self.response=response
+        self.status=response.status
+        self.failed=False
+        self.on_close=None  # called with failed on close
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data=self.response.read(amt)
+        except (socket.error, httplib.HTTPException):
+            self.failed=True
+            raise
+        if amt and not data and self.response.length:
+            # httplib takes a body cut short for its end
+            self.failed=True
+            raise httplib.IncompleteRead('', self.response.length)
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        response=self.response
+        if (not response.isclosed() and response.length is not None and
+            response.length<=self.drain_limit):
+            # cheaper than a new connection for the next query
+            try:
+                response.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+        finished=self.response.isclosed() and not self.failed
+        self.response.close()
+        self.pool.put(self.conn, finished)
+        self.conn=None
+        if self.on_close is not None:
+            self.on_close(self.failed)
+
+class GCPD_session:
+    """ Session-level HTTP transport shared by all GCPD queries.
+    Connections are kept alive and reused, one bounded pool per host,
+    so consecutive queries do not pay a TCP handshake each.
+
+    Errors are reported like urllib.URLopener does: IOError('http error',
+    errcode, errmsg, headers).
+
+    Socket operations time out after timeout seconds, and a request
+    fails with socket.timeout once it takes more than deadline seconds
+    from the request to the end of the body. With rate, each
+    host gets a GCPD_token_bucket of rate requests per second. The
+    number of requests in flight is kept by a GCPD_aimd_limiter
+    between 1 and maxsize, from the time to the response headers and
+    the failed requests.
+    """
+    max_redirects=5
+    def __init__(self, maxsize=4, timeout=60, rate=None, deadline=300):
+        self.maxsize=maxsize
+        self.timeout=timeout
+        self.deadline=deadline
+        self.rate=rate
+        self.pools={}
+        self.buckets={}
+        self.limiter=GCPD_aimd_limiter(maxsize)
+        self.lock=threading.Lock()
+
+    def pool(self, host):
+        with self.lock:
+            if host not in self.pools:
+                self.pools[host]=GCPD_connection_pool(host, self.maxsize,
+                                                      self.timeout)
+            return self.pools[host]
+
+    def take(self, url):
+        """ Waits for the rate limit of the host of url """
+        if not self.rate:
+            return
+        host=urlparse.urlsplit(url)[1]
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host]=GCPD_token_bucket(self.rate)
+            bucket=self.buckets[host]
+        bucket.take()
+
+    def open(self, url, data=None, headers=None):
+        """ GET url, or POST data to it if data is given, with extra
+        request headers. Returns a GCPD_response, which must be closed.
+        Its status is 304 if conditional headers say it is unchanged.
+        """
+        self.take(url)
+        self.limiter.acquire()
+        start=time.time()
+        try:
+            f=self._open(url, data, headers)
+        except (IOError, httplib.HTTPException), e:
+            self.limiter.release(time.time()-start, transient_error(e))
+            raise
+        except:
+            self.limiter.release(time.time()-start)
+            raise
+        latency=time.time()-start
+        f.on_close=lambda failed: self.limiter.release(latency, failed)
+        return f
+
+    def _open(self, url, data, headers):
+        deadline=None
+        if self.deadline:
+            deadline=time.time()+self.deadline
+        for i in range(self.max_redirects+1):
+            scheme,host,path,query,fragment=urlparse.urlsplit(url)
+            if query:
+                path=path+'?'+query
+            if i:
+                self.take(url)
+            pool=self.pool(host)
+            conn=pool.get()
+            conn.deadline=deadline
+            try:
+                response=self._request(conn, path or '/', data, headers)
+            except:
+                pool.put(conn, False)
+                raise
+            location=response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                self.drain(pool, conn, response)
+                url=urlparse.urljoin(url, location)
+                data=None
+                continue
+            if response.status==304 and headers:
+                return GCPD_response(pool, conn, response)
+            if response.status!=200:
+                self.drain(pool, conn, response)
+                raise IOError('http error', response.status,
+                              response.reason, response.msg)
+            return GCPD_response(pool, conn, response)
+        raise IOError('http error', response.status,
+                      'too many redirects', response.msg)
+
+    def drain(self, pool, conn, response):
+        """ Reads the unwanted body of response and hands conn back """
+        try:
+            response.read()
+        except:
+            pool.put(conn, False)
+            raise
+        pool.put(conn, response.isclosed())
+
+    def _request(self, conn, path, data, headers=None):
+        headers=dict(headers or {})
+        if data is None:
+            method='GET'
+        else:
+            method='POST'
+            headers['Content-Type']='application/x-www-form-urlencoded'
+        # the server may have dropped an idle keep-alive connection,
+        # in that case retry once on a fresh one
+        reused=conn.sock is not None
+        while True:
+            try:
+                conn.request(method, path, data, headers)
+                return conn.getresponse()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                    socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                reused=False
+
+gcpd_session=GCPD_session()
+
+def conditional_read(url, data=None, etag=None, modified=None):
+    """ (body, etag, modified) of url, POSTing data if it is given.
+    Given the ETag or Last-Modified of an earlier response, body is
+    None if the server says the content did not change since.
+    """
+    headers={}
+    if etag:
+        headers['If-None-Match']=etag
+    if modified:
+        headers['If-Modified-Since']=modified
+    f=gcpd_session.open(url, data, headers)
+    try:
+        if f.status==304:
+            return (None, f.getheader('etag', etag),
+                    f.getheader('last-modified', modified))
+        return f.read(), f.getheader('etag'), f.getheader('last-modified')
+    finally:
+        f.close()
+
+def query_description(url, data=None):
+    """ Star code and system of a GCPD query, for messages.
+
+    >>> query_description('http://x/photoSys.cgi?phot=UBV&ident=0100000432')
+    '0100000432 UBV'
+    """
+    if data is None:
+        data=urlparse.urlsplit(url)[3]
+    params=urlparse.parse_qs(data)
+    return '%s %s' % (params.get('ident', ['?'])[0],
+                      params.get('phot', ['systems'])[0])
+
+class _thread_slot(object):
+    __slots__=('item','result','error','done')
+    def __init__(self,item):
+        self.item=item
+        self.result=None
+        self.error=None
+        self.done=threading.Event()
+
+def thread_map(func, iterable, workers=4, ordered=True):
+    """ Apply func to every item of iterable in a pool of worker threads.
+    Results are yielded as soon as they are available, in input order
+    unless ordered is False, in which case they come in order of
+    completion. At most 2*workers items are in flight, so iterable
+    may be an arbitrarily long iterator.
+    An exception raised by func is re-raised in the caller. The
+    workers are joined once the results are all taken, or the caller
+    stops taking them.
+
+    >>> list(thread_map(lambda x: x*x, xrange(5), 3))
+    [0, 1, 4, 9, 16]
+    """
+    tasks=Queue.Queue()
+    finished=Queue.Queue()
+    def worker():
+        while True:
+            slot=tasks.get()
+            if slot is None:
+                return
+            try:
+                slot.result=func(slot.item)
+            except:
+                slot.error=sys.exc_info()
+            slot.done.set()
+            if not ordered:
+                finished.put(slot)
+    threads=[threading.Thread(target=worker) for i in range(max(workers,1))]
+    for t in threads:
+        t.daemon=True
+        t.start()
+    items=iter(iterable)
+    pending=collections.deque()
+    window=2*len(threads)
+    try:
+        while True:
+            while items is not None and len(pending)<window:
+                try:
+                    slot=_thread_slot(items.next())
+                except StopIteration:
+                    items=None
+                    break
+                pending.append(slot)
+                tasks.put(slot)
+            if not pending:
+                break
+            if ordered:
+                slot=pending.popleft()
+                while not slot.done.wait(1.0):
+                    pass
+            else:
+                while True:
+                    try:
+                        slot=finished.get(True, 1.0)
+                        break
+                    except Queue.Empty:
+                        pass
+                pending.remove(slot)
+            if slot.error:
+                raise slot.error[0], slot.error[1], slot.error[2]
+            yield slot.result
+    finally:
+        # items not started are dropped, the workers finish the others
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            while t.is_alive():
+                t.join(1.0)
+
+class GCPD_single_flight:
+    """ Runs concurrent calls with equal keys once: the first caller
+    runs the call, the others wait for it and get its result, or its
+    exception. Later calls with the key run again.
+
+    >>> GCPD_single_flight().do('k', lambda x: x+1, 1)
+    2
+    """
+    def __init__(self):
+        self.calls={}
+        self.lock=threading.Lock()
+
+    def do(self, key, func, *args):
+        with self.lock:
+            entry=self.calls.get(key)
+            owner=entry is None
+            if owner:
+                entry=self.calls[key]=[threading.Event(), None, None]
+        if owner:
+            try:
+                entry[1]=func(*args)
+            except:
+                entry[2]=sys.exc_info()
+            with self.lock:
+                del self.calls[key]
+            entry[0].set()
+        else:
+            entry[0].wait()
+        if entry[2] is not None:
+            raise entry[2][0], entry[2][1], entry[2][2]
+        return entry[1]
+
+gcpd_single_flight=GCPD_single_flight()
+
+class GCPD_cache:
+    """ Persistent cache of GCPD responses in an SQLite file.
+    Entries older than ttl seconds are not returned, and once the
+    bodies take more than max_size bytes the least recently used
+    entries are evicted, down to low_water times max_size. The size
+    is counted as entries are put, and read again from the file every
+    resync_puts puts, for the entries other processes put. The time
+    an entry was last used is only written when it is access_interval
+    seconds old, so most reads do not write. Bodies are stored zlib
+    compressed.
+    Queries known to have no data are kept as entries without a body,
+    valid for negative_ttl seconds. Entries keep the request, the
+    validators and a digest of their body, for refresh().
+    Any number of threads and processes may share one cache file,
+    SQLite does the locking.
+
+    >>> c=GCPD_cache(':memory:', max_size=30)
+    >>> c.access_interval=0
+    >>> c.put('a', 'a'*100); c.put('b', 'b'*100)
+    >>> c.get('a')[:3]
+    'aaa'
+    >>> c.put('c', 'c'*100)
+    >>> c.size
+    24
+    >>> c.get('a')[:3], c.get('b'), c.get('c')[:3]
+    ('aaa', None, 'ccc')
+    >>> c.ttl=-1
+    >>> c.get('a')
+    >>> c.put_negative('d')
+    >>> c.get('d')
+    Traceback (most recent call last):
+    GCPD_No_Data
+    >>> c.negative_ttl=-1
+    >>> c.get('d')
+    """
+    low_water=0.9
+    resync_puts=1000
+    access_interval=3600.
+    def __init__(self, path, ttl=30*86400, max_size=512*2**20,
+                 negative_ttl=7*86400):
+        self.path=path
+        self.ttl=ttl
+        self.max_size=max_size
+        self.negative_ttl=negative_ttl
+        self.local=threading.local()
+        self.lock=threading.Lock()
+        self.size=None  # bytes of the bodies, None until read
+        self.puts=0
+        db=self.db()
+        with db:
+            db.execute("""CREATE TABLE IF NOT EXISTS responses
+                          (key TEXT PRIMARY KEY, body BLOB, size INTEGER,
+                           stored REAL, accessed REAL, etag TEXT,
+                           modified TEXT, digest TEXT, url TEXT, data TEXT)""")
+            # caches written before refresh() lack some columns
+            columns=[r[1] for r in db.execute('PRAGMA table_info(responses)')]
+            for column in ('etag', 'modified', 'digest', 'url', 'data'):
+                if column not in columns:
+                    db.execute('ALTER TABLE responses ADD COLUMN %s TEXT'
+                               % column)
+            db.execute("""CREATE INDEX IF NOT EXISTS responses_accessed
+                          ON responses (accessed)""")
+
+    def db(self):
+        """ The connection of the calling thread """
+        db=getattr(self.local, 'db', None)
+        if db is None:
+            db=sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db=db
+        return db
+
+    def get(self, key):
+        """ Cached body for key, None if it is missing or expired.
+        Raises GCPD_No_Data if the query is known to have no data.
+        """
+        db=self.db()
+        row=db.execute('SELECT body, stored, accessed FROM responses '
+                       'WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        body,stored,accessed=row
+        now=time.time()
+        if now-stored>(self.ttl if body is not None else self.negative_ttl):
+            return None
+        if now-accessed>=self.access_interval:
+            with db:
+                db.execute('UPDATE responses SET accessed=? WHERE key=?',
+                           (now, key))
+        if body is None:
+            raise GCPD_No_Data
+        return zlib.decompress(str(body))
+
+    def put(self, key, body, etag=None, modified=None, url=None, data=None):
+        """ Store body as the response of key, which was requested
+        from url, with data if it was POSTed.
+        """
+        compressed=zlib.compress(body)
+        now=time.time()
+        db=self.db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO responses (key, body, size, '
+                       'stored, accessed, etag, modified, digest, url, data) '
+                       'VALUES (?,?,?,?,?,?,?,?,?,?)',
+                       (key, sqlite3.Binary(compressed), len(compressed),
+                        now, now, etag, modified, hashlib.sha1(body).hexdigest(),
+                        url, data))
+            self.added(db, len(compressed))
+
+    def put_negative(self, key):
+        """ Remember that the query of key has no data """
+        now=time.time()
+        db=self.db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO responses (key, body, size, '
+                       'stored, accessed) VALUES (?,?,?,?,?)',
+                       (key, None, len(key), now, now))
+            self.added(db, len(key))
+
+    def added(self, db, size):
+        """ Count an entry of size bytes just put, and evict entries
+        once the count passes max_size.
+        """
+        with self.lock:
+            self.puts+=1
+            if self.size is not None and self.puts%self.resync_puts:
+                # an entry put again is counted twice, which only
+                # makes the next eviction come early
+                self.size+=size
+                if self.size<=self.max_size:
+                    return
+        size=self.evict(db)
+        with self.lock:
+            self.size=size
+
+    def evict(self, db):
+        """ Drop least recently used entries once the bodies take more
+        than max_size, until they take low_water times max_size. Returns
+        the size left.
+        """
+        total=db.execute('SELECT COALESCE(SUM(size),0) FROM responses'
+                         ).fetchone()[0]
+        if total<=self.max_size:
+            return total
+        while total>self.max_size*self.low_water:
+            rows=db.execute('SELECT key, size FROM responses '
+                            'ORDER BY accessed LIMIT 100').fetchall()
+            for key,size in rows:
+                db.execute('DELETE FROM responses WHERE key=?', (key,))
+                total-=size
+                if total<=self.max_size*self.low_water:
+                    break
+        return total
+
+    def refresh(self, age, jobs=4):
+        """ Revalidate the bodies stored more than age seconds ago with
+        conditional requests, jobs at a time. Entries the server reports
+        unchanged, or which come back with the same digest, only get a
+        new stored time; changed bodies replace the old ones. Entries
+        without data, or stored before requests were kept, are left to
+        expire. Yields a message for every changed entry and every
+        failed request, and a summary at the end.
+        """
+        rows=self.db().execute('SELECT key, etag, modified, digest, url, '
+                               'data FROM responses WHERE stored<? AND body '
+                               'IS NOT NULL AND url IS NOT NULL',
+                               (time.time()-age,)).fetchall()
+        def revalidate(row):
+            key,etag,modified,digest,url,data=row
+            try:
+                return row, gcpd_retry.call(conditional_read, url, data,
+                                            etag, modified)
+            except IOError,k:
+                return row, k
+        counts={'changed':0, 'not modified':0, 'same':0, 'failed':0}
+        db=self.db()
+        for row,r in thread_map(revalidate, rows, jobs, False):
+            key,etag,modified,digest,url,data=row
+            if isinstance(r, IOError):
+                counts['failed']+=1
+                yield io_error_message(r)
+                continue
+            body,etag,modified=r
+            if body is not None and hashlib.sha1(body).hexdigest()!=digest:
+                counts['changed']+=1
+                self.put(key, body, etag, modified, url, data)
+                yield '# changed %s' % query_description(url, data)
+                continue
+            counts['same' if body is not None else 'not modified']+=1
+            with db:
+                db.execute('UPDATE responses SET stored=?, etag=?, '
+                           'modified=? WHERE key=?',
+                           (time.time(), etag, modified, key))
+        yield ('# refreshed %d cache entries: %d changed, %d not modified, '
+               '%d same, %d failed' % (len(rows), counts['changed'],
+               counts['not modified'], counts['same'], counts['failed']))
+
+gcpd_cache=None
+
+class GCPD_mirror:
+    """ Read-only local mirror of photoSys.cgi responses, built by
+    harvest_mirror. The directory path holds a data file of zlib
+    compressed response bodies and an index file, both opened with
+    mmap. The index is an open addressing hash table of fixed width
+    slots, keyed by the 10 digit star_code, the system and the rem
+    code, so a lookup reads one or two slots.
+
+    With strict, queries missing from the mirror raise IOError instead
+    of going to the network. The ETag and Last-Modified of each body,
+    used by refresh_mirror, are kept apart in a validators file.
+
+    >>> import tempfile, shutil
+    >>> path=tempfile.mkdtemp()
+    >>> keys=[GCPD_mirror.pack_key('01000000%02d' % n, 'UBV', '')
+    ...       for n in range(20)]
+    >>> body=zlib.compress('<HTML>')
+    >>> open(os.path.join(path, 'data'), 'wb').write(body*20)
+    >>> GCPD_mirror.write_index(path, dict([(k, (n*len(body), len(body)))
+    ...                                     for n,k in enumerate(keys)]))
+    >>> m=GCPD_mirror(path, strict=True)
+    >>> m.slots, len(m.entries())
+    (64, 20)
+    >>> set([m.get('01000000%02d' % n, 'UBV') for n in range(20)])
+    set(['<HTML>'])
+    >>> m.get('0100000099', 'UBV') # doctest:+ELLIPSIS
+    Traceback (most recent call last):
+    IOError: [Errno mirror] not in mirror ...
+    >>> shutil.rmtree(path)
+    """
+    magic='GCPDMIR1'
+    header=struct.Struct('<8sQ')
+    key=struct.Struct('<10s16s8s')
+    slot=struct.Struct('<10s16s8sQI')   # key, offset, length
+    empty='\0'*key.size
+
+    def __init__(self, path, strict=False):
+        self.path=path
+        self.strict=strict
+        self.index=self.map(os.path.join(path, 'index'))
+        magic,self.slots=self.header.unpack_from(self.index)
+        if magic!=self.magic:
+            raise IOError('mirror', 'not a GCPD mirror index', path)
+        self.data=self.map(os.path.join(path, 'data'))
+
+    def map(self, name):
+        f=open(name, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size==0:
+                return ''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    @classmethod
+    def pack_key(cls, code, system, rem):
+        """ Index key, None if the fields do not fit a slot """
+        if not (len(code)==10 and code.isdigit() and len(system)<=16
+                and len(rem)<=8):
+            return None
+        return cls.key.pack(code, system, rem)
+
+    def get(self, code, system, rem=''):
+        """ Response body of a star code in system, None if it is not
+        in the mirror.
+        """
+        key=self.pack_key(code, system, rem.strip())
+        if key is not None:
+            i=zlib.crc32(key)&(self.slots-1)
+            while True:
+                pos=self.header.size+i*self.slot.size
+                k=self.index[pos:pos+self.key.size]
+                if k==key:
+                    offset,length=struct.unpack_from('<QI', self.index,
+                                                     pos+self.key.size)
+                    return zlib.decompress(self.data[offset:offset+length])
+                if k==self.empty:
+                    break
+                i=(i+1)&(self.slots-1)
+        if self.strict:
+            raise IOError('mirror', 'not in mirror %s' % self.path)
+        return None
+
+    def entries(self):
+        """ {key: (offset, length)} of all bodies """
+        r={}
+        for i in xrange(self.slots):
+            pos=self.header.size+i*self.slot.size
+            fields=self.slot.unpack_from(self.index, pos)
+            if fields[0]!='\0'*10:
+                r[self.key.pack(*fields[:3])]=fields[3:]
+        return r
+
+    @classmethod
+    def write_index(cls, path, entries):
+        """ Write the index of entries {key: (offset, length)} in place
+        of the old one, readers keep their old mapping.
+        """
+        slots=8
+        while slots<2*len(entries):
+            slots*=2
+        index=bytearray(cls.header.size+slots*cls.slot.size)
+        cls.header.pack_into(index, 0, cls.magic, slots)
+        for key,(offset,length) in entries.items():
+            i=zlib.crc32(key)&(slots-1)
+            while True:
+                pos=cls.header.size+i*cls.slot.size
+                if index[pos:pos+cls.key.size]==cls.empty:
+                    break
+                i=(i+1)&(slots-1)
+            index[pos:pos+cls.key.size]=key
+            struct.pack_into('<QI', index, pos+cls.key.size, offset, length)
+        cls.replace_file(os.path.join(path, 'index'), index)
+
+    @classmethod
+    def read_validators(cls, path):
+        """ {key: (etag, modified)} of the bodies in the mirror """
+        try:
+            f=open(os.path.join(path, 'validators'), 'rb')
+        except IOError:
+            return {}
+        try:
+            return dict([(k.decode('hex'), tuple(v))
+                         for k,v in json.load(f).items()])
+        finally:
+            f.close()
+
+    @classmethod
+    def write_validators(cls, path, validators):
+        cls.replace_file(os.path.join(path, 'validators'),
+                         json.dumps(dict([(k.encode('hex'), v) for k,v in
+                                          validators.items()])))
+
+    @staticmethod
+    def replace_file(name, content):
+        """ Write content in place of file name, readers of the old
+        file keep it.
+        """
+        f=open(name+'.tmp', 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(name+'.tmp', name)
+
+gcpd_mirror=None
+
+def query_key(action_url, params):
+    """ Normalized key of a GCPD query, used for caching.
+
+    >>> query_key('http://x/photoSys.cgi?', {'rem':' AB', 'ident':'0100000001'})
+    'http://x/photoSys.cgi?ident=0100000001&rem=AB'
+    """
+    items=sorted([(k, str(v).strip()) for k,v in params.items()])
+    return action_url + urllib.urlencode(items)
+
+def query_request(action_url, params, post=False):
+    """ (url, data) to request for a GCPD query, data None for GET """
+    if post:
+        return action_url,urllib.urlencode(params)
+    return action_url + urllib.urlencode(params),None
+
+def read_query(action_url, params, post=False):
+    """ The response body of a GCPD query, like feed_query but read
+    whole and not parsed.
+    """
+    key=None
+    if gcpd_cache is not None:
+        key=query_key(action_url, params)
+        s=gcpd_cache.get(key)
+        if s is not None:
+            return s
+    url,data=query_request(action_url, params, post)
+    f=gcpd_session.open(url, data)
+    try:
+        body=f.read()
+    finally:
+        f.close()
+    if key is not None:
+        gcpd_cache.put(key, body, f.getheader('etag'),
+                       f.getheader('last-modified'), url, data)
+    return body
+
+def feed_query(h, action_url, params, post=False, chunk_size=8192):
+    """ Send a GCPD query, as GET unless post is true, and feed the
+    response body to the parser h chunk by chunk as it arrives.
+    The body is taken from gcpd_cache when it holds a fresh copy,
+    GCPD_No_Data is raised if the cache knows the query has no data.
+    When h raises GCPD_No_Data on a 'No values' page, that is recorded
+    in the cache and the connection is dropped without reading the rest.
+    Once h is done, the rest is not parsed. It is still read into the
+    cache if there is one, otherwise the connection is dropped.
+    """
+    key=None
+    if gcpd_cache is not None:
+        key=query_key(action_url, params)
+        s=gcpd_cache.get(key)
+        if s is not None:
+            h.feed(s)
+            return h
+    url,data=query_request(action_url, params, post)
+    f=gcpd_session.open(url, data)
+    chunks=[]
+    try:
+        pending=''
+        while True:
+            chunk=f.read(chunk_size)
+            if not chunk:
+                break
+            if key is not None:
+                chunks.append(chunk)
+            if h.done:
+                continue
+            pending=feed_chunk(h, pending, chunk)
+            if h.done and key is None:
+                break # the rest is not wanted
+        h.feed(pending)
+    except GCPD_No_Data:
+        record_no_data(action_url, params)
+        raise
+    finally:
+        f.close()
+    if key is not None:
+        gcpd_cache.put(key, ''.join(chunks), f.getheader('etag'),
+                       f.getheader('last-modified'), url, data)
+    return h
+
+def feed_chunk(h, pending, chunk):
+    """ Feed the parser h with pending+chunk, the rest of a response
+    so far, up to its last tag start. Returns what is left for later.
+
+    >>> h=GCPD_tokenizer()
+    >>> data=[]
+    >>> h.handle_data=data.append
+    >>> pending=feed_chunk(h, '', 'No val')
+    >>> pending=feed_chunk(h, pending, 'ues<b')
+    >>> data, pending
+    (['No values'], '<b')
+    """
+    # sgmllib hands text cut by the end of a chunk to handle_data
+    # in two pieces, so only feed up to the last tag start
+    pending=pending+chunk
+    i=pending.rfind('<')
+    if i>0:
+        h.feed(pending[:i])
+        pending=pending[i:]
+    return pending
+
+def record_no_data(action_url, params):
+    """ Remember in gcpd_cache that a GCPD query has no data """
+    if gcpd_cache is not None:
+        gcpd_cache.put_negative(query_key(action_url, params))
+
+_endbracket=re.compile('[<>]')
+_tagfind=re.compile('[a-zA-Z][-_.a-zA-Z0-9]*')
+_shorttagopen=re.compile('<[a-zA-Z][-.a-zA-Z0-9]*/')
+_shorttag=re.compile('<([a-zA-Z][-.a-zA-Z0-9]*)/([^/]*)/')
+_commentclose=re.compile(r'--\s*>')
+_attrfind=re.compile(
+    r'\s*([a-zA-Z_][-:.a-zA-Z_0-9]*)(\s*=\s*'
+    r'(\'[^\']*\'|"[^"]*"|[][\-a-zA-Z0-9./,:;+*%?!&$\(\)_#=~\'"@]*))?')
+_entity_or_charref=re.compile('&(?:([a-zA-Z][-.a-zA-Z0-9]*)|#([0-9]+))(;?)')
+_entityref=re.compile('&([a-zA-Z][-.a-zA-Z0-9]*)[^a-zA-Z0-9]')
+_charref=re.compile('&#([0-9]+)[^0-9]')
+_incomplete_ref=re.compile('&([a-zA-Z][a-zA-Z0-9]*|#[0-9]*)?')
+_tag_methods={}
+_plain_tags={}
+
+class _ParseDone(Exception):
+    """ Raised by a handler when the parser needs no more input """
+
+class GCPD_tokenizer:
+    """ Incremental single-pass tokenizer for the HTML of GCPD pages,
+    a fast replacement for htmllib.HTMLParser with the same interface.
+    Text is passed to handle_data, split at tags and at entity and
+    character references exactly as sgmllib does. A tag calls
+    start_<tag>(attrs) or do_<tag>(attrs) of the subclass and
+    end tags call end_<tag>() with sgmllib's rules for unclosed tags.
+    Tags without a handler are skipped. Arguments of the constructor
+    are ignored, so a formatter may still be passed.
+
+    A handler can raise _ParseDone once the subclass has what it
+    needs; done is then set and further input is ignored.
+
+    >>> class Echo(GCPD_tokenizer):
+    ...     def handle_data(self, data): print repr(data)
+    ...     def start_b(self, attrs): print 'b', attrs
+    ...     def end_b(self): print '/b'
+    >>> h=Echo()
+    >>> h.feed('<b class=x>R&amp;D</b><!-- c --><i>')
+    b [('class', 'x')]
+    'R'
+    '&'
+    'D'
+    /b
+    >>> h.close()
+    """
+    entitydefs=htmlentitydefs.entitydefs
+    # tags htmllib keeps on its stack of open tags
+    container_tags=frozenset(['a', 'address', 'b', 'blockquote', 'body',
+                              'cite', 'code', 'dir', 'dl', 'em', 'h1', 'h2',
+                              'h3', 'h4', 'h5', 'h6', 'head', 'html', 'i',
+                              'kbd', 'listing', 'menu', 'ol', 'pre', 'samp',
+                              'strong', 'title', 'tt', 'ul', 'var', 'xmp'])
+
+    def __init__(self, *args, **kw):
+        self.rawdata=''
+        self.stack=[]
+        self.lasttag='???'
+        cls=self.__class__
+        if cls not in _tag_methods:
+            _tag_methods[cls]=[[(name[len(prefix):], name) for name in dir(cls)
+                                if name.startswith(prefix)]
+                               for prefix in ('start_', 'end_', 'do_')]
+        self.starts,self.ends,self.dos=[
+            dict([(tag, getattr(self, name)) for tag,name in methods])
+            for methods in _tag_methods[cls]]
+
+    done=False
+
+    def feed(self, data):
+        if self.done:
+            return
+        self.rawdata=self.rawdata+data
+        try:
+            self.goahead(False)
+        except _ParseDone:
+            self.done=True
+            self.rawdata=''
+
+    def close(self):
+        if self.done:
+            return
+        try:
+            self.goahead(True)
+        except _ParseDone:
+            self.done=True
+            self.rawdata=''
+
+    def handle_data(self, data):
+        pass
+
+    def goahead(self, end):
+        """ Process rawdata in one pass. The buffer is split at '<', so
+        every piece holds one tag and the text after it. Start and end
+        tags are handled here; comments, declarations, the <tag/data/
+        shorthand and incomplete tags go through parse_tag.
+        """
+        rawdata=self.rawdata
+        n=len(rawdata)
+        handle_data=self.handle_data
+        stack=self.stack
+        starts=self.starts
+        ends=self.ends
+        dos=self.dos
+        containers=self.container_tags
+        i=rawdata.find('<')
+        if i<0:
+            i=n
+        pos=i
+        if i>0:
+            i=self.goahead_text(rawdata, 0, i)
+        if i==pos<n:
+            for piece in rawdata[pos+1:].split('<'):
+                start=pos
+                pos=pos+1+len(piece) # the next '<', or the end
+                if start<i:
+                    # the tag was taken by parse_tag together with
+                    # some of the following input
+                    if i<pos:
+                        i=self.goahead_text(rawdata, i, pos)
+                        if i<pos:
+                            break
+                    continue
+                head,closed,text=piece.partition('>')
+                if closed or pos<n:
+                    if head[:1]=='/':
+                        tag=head[1:].strip().lower()
+                        if stack and stack[-1]==tag:
+                            method=ends.get(tag)
+                            if method is not None:
+                                method()
+                            del stack[-1]
+                        else:
+                            self.finish_endtag(tag)
+                    else:
+                        tag=_plain_tags.get(head)
+                        k=len(head)
+                        if tag is None:
+                            match=_tagfind.match(head)
+                            if match:
+                                k=match.end()
+                                if head[k:k+1]!='/': # not <tag/data/
+                                    tag=head[:k].lower()
+                                    if k==len(head) and len(_plain_tags)<1000:
+                                        _plain_tags[head]=tag
+                        if tag is not None:
+                            self.lasttag=tag
+                            method=starts.get(tag)
+                            if method is not None:
+                                stack.append(tag)
+                            elif tag in containers:
+                                stack.append(tag)
+                            else:
+                                method=dos.get(tag)
+                            if method is not None:
+                                method(self.parse_attrs(rawdata, start+1+k,
+                                                        start+1+len(head)))
+                    if tag is not None:
+                        if text:
+                            if '&' in text:
+                                i=self.goahead_text(rawdata, pos-len(text), pos)
+                                if i<pos:
+                                    break
+                            else:
+                                handle_data(text)
+                        i=pos
+                        continue
+                # anything else, or a tag still incomplete
+                i=self.parse_tag(rawdata, start)
+                if i<0:
+                    i=start
+                    break
+                if i<pos:
+                    i=self.goahead_text(rawdata, i, pos)
+                    if i<pos:
+                        break
+        if end and i<n:
+            handle_data(rawdata[i:n])
+            i=n
+        self.rawdata=rawdata[i:]
+
+    def goahead_text(self, rawdata, i, j):
+        """ Pass text between tags from i to j, with entity and
+        character references. Returns where it stopped. """
+        while i<j:
+            k=rawdata.find('&', i, j)
+            if k<0:
+                self.handle_data(rawdata[i:j])
+                return j
+            if i<k:
+                self.handle_data(rawdata[i:k])
+            i=self.parse_ref(rawdata, k)
+            if i<0:
+                return k
+        return i
+
+    def parse_tag(self, rawdata, i):
+        c=rawdata[i+1:i+2]
+        if c=='/':
+            match=_endbracket.search(rawdata, i+1)
+            if not match:
+                return -1
+            j=match.start()
+            tag=rawdata[i+2:j].strip().lower()
+            if rawdata[j]=='>':
+                j=j+1
+            self.finish_endtag(tag)
+            return j
+        if c=='>' or ('a'<=c<='z') or ('A'<=c<='Z'):
+            if _shorttagopen.match(rawdata, i):
+                # SGML shorthand: <tag/data/ is <tag>data</tag>
+                match=_shorttag.match(rawdata, i)
+                if not match:
+                    return -1
+                tag,data=match.group(1, 2)
+                tag=tag.lower()
+                self.finish_starttag(tag, rawdata, 0, 0)
+                self.handle_data(data)
+                self.finish_endtag(tag)
+                return match.end()
+            match=_endbracket.search(rawdata, i+1)
+            if not match:
+                return -1
+            j=match.start()
+            if c=='>':
+                k=j
+                tag=self.lasttag
+            else:
+                k=_tagfind.match(rawdata, i+1).end()
+                tag=rawdata[i+1:k].lower()
+                self.lasttag=tag
+            self.finish_starttag(tag, rawdata, k, j)
+            if rawdata[j]=='>':
+                j=j+1
+            return j
+        if rawdata.startswith('<!--', i):
+            match=_commentclose.search(rawdata, i+4)
+            if not match:
+                return -1
+            return match.end()
+        if c=='!' and rawdata[i+2:i+3] in ('-', ''):
+            return -1 # like sgmllib, wait for the end of a comment
+        if c=='!' or c=='?':
+            j=rawdata.find('>', i+2)
+            if j<0:
+                return -1
+            return j+1
+        if i+1==len(rawdata):
+            return -1
+        self.handle_data('<')
+        return i+1
+
+    def parse_ref(self, rawdata, i):
+        match=_charref.match(rawdata, i)
+        if match:
+            self.handle_charref(match.group(1))
+        else:
+            match=_entityref.match(rawdata, i)
+            if match:
+                self.handle_entityref(match.group(1))
+        if match:
+            j=match.end()
+            if rawdata[j-1]!=';':
+                j=j-1
+            return j
+        j=_incomplete_ref.match(rawdata, i).end()
+        if j==len(rawdata):
+            return -1
+        self.handle_data(rawdata[i:j])
+        return j
+
+    def parse_attrs(self, rawdata, k, j):
+        if k>=j:
+            return []
+        attrs=[]
+        while k<j:
+            match=_attrfind.match(rawdata, k)
+            if not match:
+                break
+            name,rest,value=match.group(1, 2, 3)
+            if not rest:
+                value=name
+            else:
+                if (value[:1]=="'"==value[-1:] or
+                    value[:1]=='"'==value[-1:]):
+                    value=value[1:-1]
+                value=_entity_or_charref.sub(self.convert_ref, value)
+            attrs.append((name.lower(), value))
+            k=match.end()
+        return attrs
+
+    def finish_starttag(self, tag, rawdata, k, j):
+        method=self.starts.get(tag)
+        if method is not None:
+            self.stack.append(tag)
+        else:
+            if tag in self.container_tags:
+                self.stack.append(tag)
+                return
+            method=self.dos.get(tag)
+            if method is None:
+                return
+        if k<j:
+            method(self.parse_attrs(rawdata, k, j))
+        else:
+            method([])
+
+    def finish_endtag(self, tag):
+        stack=self.stack
+        if not tag:
+            found=len(stack)-1
+            if found<0:
+                return
+        else:
+            if tag not in stack:
+                return
+            found=len(stack)-1-stack[::-1].index(tag)
+        while len(stack)>found:
+            method=self.ends.get(stack[-1])
+            if method is not None:
+                method()
+            del stack[-1]
+
+    def convert_charref(self, name):
+        n=int(name)
+        if 0<=n<=127:
+            return chr(n)
+
+    def convert_ref(self, match):
+        if match.group(2):
+            return (self.convert_charref(match.group(2)) or
+                    '&#%s%s' % match.groups()[1:])
+        elif match.group(3):
+            return (self.entitydefs.get(match.group(1)) or
+                    '&%s;' % match.group(1))
+        else:
+            return '&%s' % match.group(1)
+
+    def handle_charref(self, name):
+        c=self.convert_charref(name)
+        if c is not None:
+            self.handle_data(c)
+
+    def handle_entityref(self, name):
+        if name in self.entitydefs:
+            self.handle_data(self.entitydefs[name])
+
+# A genIndex.cgi and a photoSys.cgi page, for the doctests
+sample_index_page="""<HTML><BODY><H3>Systems</H3>
+<TABLE BORDER=1>
+<TR><TH>System</TH><TH>Designation</TH><TH>Nb</TH></TR>
+<TR><TD><A HREF="x?1">10</A></TD><TD><A HREF="y?1">UBV</A></TD><TD>3</TD></TR>
+<TR><TD><A HREF="x?2">81</A></TD><TD><A HREF="y?2">uvby</A></TD><TD>1</TD></TR>
+</TABLE></BODY></HTML>
+"""
+sample_photo_page="""<HTML><HEAD><TITLE>GCPD photometric data</TITLE></HEAD>
+<BODY>
+<H3>Selection:</H3>
+<B>Star Name:</B> HD 184313
+<B>Star Code:</B> 0100184313
+<B>Rem:</B>
+<B>Nb Sources:</B> 2
+<B>References:</B> 1
+<HR>
+<PRE><B>	V	B-V	Ref</B>
+	6.33	1.57	1
+	6.45		2
+</PRE>
+<HR>
+<PRE><B>Author</B>	Eggen O.J.
+<B>Journal</B>	(1973) Mem. Roy. Astron. Soc. 77, 159
+<B>Bibcode</B>	<A HREF="http://adsabs.harvard.edu/abs/1973MmRAS..77..159E">1973MmRAS..77..159E</A>
+</PRE>
+<HR>
+<ADDRESS>GCPD</ADDRESS></BODY></HTML>
+"""
+
+class GCPD_table_parser(GCPD_tokenizer):
     """ Parse a table describing which systems are available
     for given star
+
+    >>> h=GCPD_table_parser()
+    >>> h.feed(sample_index_page); h.close()
+    >>> h.syslist, h.sys_number_list
+    (['UBV', 'uvby'], ['10', '81'])
     """
     def __init__(self,*args, **kw):
-        htmllib.HTMLParser.__init__(self,*args, **kw)
+        GCPD_tokenizer.__init__(self,*args, **kw)
         self.row=0
         self.column=0
         self.syslist=[]
@@ -215,49 +1961,109 @@ class GCPD_table_parser(htmllib.HTMLParser):
                  self.description[self.column]=='System':
             self.sys_number_list.append(data.strip())
             
-def GCPD_system_list(starname,rem):
-    action_url='http://obswww.unige.ch/gcpd/cgi-bin/genIndex.cgi'
-    params = urllib.urlencode({'ident':translate_name(starname),
-                               'button':'Query by Star Number'})
-    f = urllib.urlopen(action_url, params)
-   
+GCPD_index_action='http://obswww.unige.ch/gcpd/cgi-bin/genIndex.cgi'
 
-    h = GCPD_table_parser(formatter.NullFormatter())
-    s=f.read()
-    h.feed(s)
-    f.close()
+def system_list_params(starname):
+    """ POST parameters of the genIndex.cgi query for starname """
+    return {'ident':star_code(starname),
+            'button':'Query by Star Number'}
+
+def parsed_system_list(h, params):
+    """ The systems read by h, a GCPD_table_parser fed with the
+    genIndex.cgi response for params. Raises GCPD_No_Data if there
+    are none.
+    """
     if len(h.syslist)==0:
+        record_no_data(GCPD_index_action, params)
         raise GCPD_No_Data
     return h.syslist
+
+def GCPD_system_list(starname,rem=''):
+    action_url=GCPD_index_action
+    params=system_list_params(starname)
+    def query():
+        h = GCPD_table_parser()
+        feed_query(h, action_url, params, post=True)
+        return parsed_system_list(h, params)
+    # concurrent queries of one star share one request
+    return list(gcpd_single_flight.do(('POST', query_key(action_url, params)),
+                                      gcpd_retry.call, query))
     
     
-class GCPD_parser(htmllib.HTMLParser):
-    """ 
+class GCPD_parser(GCPD_tokenizer):
+    """ Parse a photoSys.cgi page. The page is a state machine over
+    sections separated by <hr>: metadata (starting with the
+    'Selection:' header), photometry data and references. Within a
+    section every <b> name is followed by its value, the photometry
+    data is the text after the <b> column names in the data <pre>,
+    each <pre> of the reference section is one reference.
+
+    sections, a keyword argument, lists the sections to extract,
+    all three by default. Others are skipped, and the parser is done
+    once the last wanted section is over.
+
+    A page gives the same results fed whole or in pieces of any size
+    through feed_chunk, as feed_query does:
+
+    >>> def parse(chunks, sections=GCPD_parser.all_sections):
+    ...     h=GCPD_parser(sections=sections)
+    ...     pending=''
+    ...     for chunk in chunks:
+    ...         pending=feed_chunk(h, pending, chunk)
+    ...     h.feed(pending); h.close()
+    ...     return (h.starname, h.starcode, h.rem, h.number_of_sources,
+    ...             h.photo_data, h.column_names, h.references)
+    >>> page=parse([sample_photo_page])
+    >>> page[:4]
+    ('HD 184313', '0100184313', '', '2')
+    >>> page[4:6]
+    ('\\n\\t6.33\\t1.57\\t1\\n\\t6.45\\t\\t2\\n', ['', 'V', 'B-V', 'Ref'])
+    >>> [sorted(r.items()) for r in page[6]] # doctest: +NORMALIZE_WHITESPACE
+    [[('Author', 'Eggen O.J.'), ('Bibcode', '1973MmRAS..77..159E'),
+      ('BibcodeURL', 'http://adsabs.harvard.edu/abs/1973MmRAS..77..159E'),
+      ('Journal', '(1973) Mem. Roy. Astron. Soc. 77, 159')]]
+    >>> all([parse([sample_photo_page[i:i+n] for i in
+    ...             range(0, len(sample_photo_page), n)])==page
+    ...      for n in (1, 2, 3, 7, 64)])
+    True
+    >>> h=GCPD_parser(sections=[GCPD_parser.DATA])
+    >>> h.feed(sample_photo_page); h.close()
+    >>> h.done, (h.photo_data, h.column_names)==page[4:6], h.references
+    (True, True, [])
     """
     metadata={'Star Name:':'starname',
               'Star Code:':'starcode',
               'Rem:':'rem',
               'Nb Sources:':'number_of_sources',
               'References:':'references_num'}
+    metadata_pattern=re.compile('|'.join([re.escape(k) for k in metadata]))
     error_message='No values'.upper()
+    METADATA,DATA,REFERENCES=0,1,2
+    all_sections=(METADATA,DATA,REFERENCES)
     def __init__(self, *args, **kw):
-        htmllib.HTMLParser.__init__(self,*args, **kw)
+        sections=kw.pop('sections', self.all_sections)
+        GCPD_tokenizer.__init__(self,*args, **kw)
+        self.wanted=[s in sections for s in self.all_sections]
+        self.last_section=max(sections)
+        self.selection=False
         self.inside_b=False
         self.waiting_for_data_b=False
         self.hr_number=0
         self.references=[]
         self.metadata_section=0
+        self.section=self.METADATA
         self.inside_h3=False
-        #self.starting_ref=False
+        self.b_name=''
+        self.b_metadata=None
 
     def inside_ref_section(self):
-        return self.hr_number==self.metadata_section+2
+        return self.section==self.REFERENCES
 
     def inside_data_section(self):
-        return self.hr_number==self.metadata_section+1
+        return self.section==self.DATA
 
     def start_pre(self,data):
-        if self.inside_ref_section():
+        if self.section==self.REFERENCES and self.wanted[self.REFERENCES]:
             self.current_reference={}
 
 
@@ -265,33 +2071,34 @@ class GCPD_parser(htmllib.HTMLParser):
         """ Photometry data -- the last before /pre
         This simple algorithm chokes on 13-color photometry system
         """
-        if self.inside_data_section():
+        if self.section==self.DATA and self.wanted[self.DATA]:
             self.photo_data=self.last_postb_data
             self.column_names=self.b_name.split('\t')
-        if self.inside_ref_section():
+        if self.section==self.REFERENCES and self.wanted[self.REFERENCES]:
             self.references.append(self.current_reference)
 
         
     def handle_data(self,data):
-       
-        cd=data.upper()
-        dd=data.strip()
-        if re.match(self.error_message,cd):
+        if (data[:1] in 'Nn' and
+            data[:len(self.error_message)].upper()==self.error_message):
             raise GCPD_No_Data
-        if self.inside_b:
-            self.b_name=data #Not dd!
         if self.inside_h3:
-            if data.upper().strip()=='Selection:'.upper():
+            if data.strip().upper()=='SELECTION:':
                 self.metadata_section=self.hr_number
-        
-        if self.waiting_for_data_b and not self.inside_b:
-            for k in self.metadata:
-                if re.match(k,self.b_name):
-                    setattr(self,self.metadata[k],dd)
-            if self.inside_data_section():
+                self.section=self.METADATA
+                self.selection=True
+        if self.inside_b:
+            self.b_name=data #Not stripped!
+            match=self.metadata_pattern.match(data)
+            self.b_metadata=match and self.metadata[match.group()]
+        elif self.waiting_for_data_b:
+            if self.b_metadata and self.wanted[self.METADATA]:
+                setattr(self,self.b_metadata,data.strip())
+            if self.section==self.DATA:
                 self.waiting_for_data_b=False
                 self.last_postb_data=data
-            elif self.inside_ref_section():
+            elif self.section==self.REFERENCES and self.wanted[self.REFERENCES]:
+                dd=data.strip()
                 if dd!='':
                     self.current_reference[self.b_name]=dd
                     self.waiting_for_data_b=False
@@ -309,6 +2116,8 @@ class GCPD_parser(htmllib.HTMLParser):
         self.inside_b=False
 
     def start_a(self,attr):
+        if not self.wanted[self.REFERENCES]:
+            return
         if self.waiting_for_data_b and self.b_name.upper()=='BIBCODE':
             if attr[0][0] == "href" :
                 url=attr[0][1]
@@ -317,136 +2126,226 @@ class GCPD_parser(htmllib.HTMLParser):
           
 
     def start_hr(self,attrs):
-        """ Horizontal rulers separate sections
+        """ Horizontal rulers separate sections. After the last wanted
+        section the parser is done, the rest of the page is not read;
+        if the data section was wanted but had no data, there is none.
+
+        >>> h=GCPD_parser(sections=[GCPD_parser.DATA])
+        >>> h.feed('<h3>Selection:</h3><hr><pre><b>\\tV</b>\\t6.5\\n</pre>'
+        ...        '<hr>No values')
+        >>> h.done, h.photo_data
+        (True, '\\t6.5\\n')
+        >>> GCPD_parser().feed('<h3>Selection:<hr><HR><hr>No values')
+        Traceback (most recent call last):
+        GCPD_No_Data
         """
         self.hr_number+=1
+        self.section=self.hr_number-self.metadata_section
+        if self.selection and self.section>self.last_section:
+            if self.wanted[self.DATA] and not hasattr(self, 'photo_data'):
+                raise GCPD_No_Data
+            raise _ParseDone
         
    
 
+class GCPD_derivation:
+    """ Derivation of the bands of a system from the columns of its
+    photoSys.cgi table, compiled from a declarative description with
+    one node per line:
+
+        name = term [+|- term] [| fallback]
+
+    where a term is a table column in brackets or an earlier or later
+    node. A fallback column fills the values the expression leaves
+    empty. Nodes starting with '_' are intermediate and not returned.
+    Steps are checked and ordered once, evaluate() then computes each
+    node exactly once.
+
+    >>> g=GCPD_derivation('''
+    ...     B = V + [B-V]
+    ...     V = [V]
+    ...     ''', ['B', 'V'])
+    >>> g.order
+    ['V', 'B']
+    >>> sorted(g.evaluate({'V':['1.5', ''], 'B-V':['0.5', '1']}).items())
+    [('B', [2.0, '']), ('V', [1.5, ''])]
+    >>> GCPD_derivation('V = B + [B-V]', ['V'])
+    Traceback (most recent call last):
+    ...
+    DerivationError: undefined node B in V = B + [B-V]
+    """
+    _line=re.compile(r'^\s*(\w+)\s*=\s*(\[[^]]+\]|\w+)'
+                     r'(?:\s*([-+])\s*(\[[^]]+\]|\w+))?'
+                     r'(?:\s*\|\s*(\[[^]]+\]))?\s*$')
+
+    def __init__(self,text,bands):
+        self.text=text
+        steps={}
+        names=[]
+        for line in text.split('\n'):
+            if not line.strip():
+                continue
+            m=self._line.match(line)
+            if not m:
+                raise DerivationError('bad derivation line: '+line.strip())
+            name,left,op,right,fallback=m.groups()
+            if name in steps:
+                raise DerivationError('node %s defined twice' % name)
+            steps[name]=(line.strip(),left,op,right,fallback)
+            names.append(name)
+        for name,(line,left,op,right,fallback) in steps.items():
+            for term in (left,right):
+                if term and term[0]!='[' and term not in steps:
+                    raise DerivationError('undefined node %s in %s' %
+                                          (term,line))
+        for b in bands:
+            if b not in steps:
+                raise DerivationError('band %s is not derived' % b)
+        # depth first topological sort, in order of definition lines
+        self.order=[]
+        state={}
+        def visit(name):
+            if state.get(name)=='done':
+                return
+            if state.get(name)=='visiting':
+                raise DerivationError('cycle through node %s' % name)
+            state[name]='visiting'
+            line,left,op,right,fallback=steps[name]
+            for term in (left,right):
+                if term and term[0]!='[':
+                    visit(term)
+            state[name]='done'
+            self.order.append(name)
+        for name in names:
+            visit(name)
+        self.steps=[(name,)+steps[name][1:] for name in self.order]
+
+    def evaluate(self,d):
+        """ Bands from the columns d of parse_data """
+        values={}
+        def value(term):
+            if term[0]=='[':
+                return d[term[1:-1]]
+            return values[term]
+        for name,left,op,right,fallback in self.steps:
+            if op is None:
+                v=float_list(value(left))
+            elif op=='+':
+                v=add_list(value(left),value(right))
+            else:
+                v=sub_list(value(left),value(right))
+            if fallback:
+                v=fill_list(v,value(fallback))
+            values[name]=v
+        return dict([(k,v) for k,v in values.items() if k[0]!='_'])
+
+_derivations={}
+def compile_derivation(text,bands):
+    """ GCPD_derivation for text, compiled only once """
+    key=(text,tuple(bands))
+    if key not in _derivations:
+        _derivations[key]=GCPD_derivation(text,bands)
+    return _derivations[key]
+
+# derive the bands with numpy array operations, see process_columns
+gcpd_vectorized=False
+
 class _GCPD:
     ""
     query_type    ='original'
+    table_delimiter='\t'  # None for whitespace, see parse_table
     GCPD_action="http://obswww.unige.ch/gcpd/cgi-bin/photoSys.cgi?"
    
     
-    def fetch_data(self,starname,rem):
+    def query_params(self,starname,rem,sections=GCPD_parser.all_sections):
         d={}
         d['phot']=self.system_string
         d['type']=self.query_type                # as mean or ...
-        d['refer']='with'
-        d['ident']=translate_name(starname)
+        if GCPD_parser.REFERENCES in sections:
+            d['refer']='with'
+        d['ident']=star_code(starname)
         d['mode']='starno'
-        query = urllib.urlencode(d)+'&rem='+rem
-        op=urllib.URLopener().open
-        f=op(self.GCPD_action+query)
-        h = GCPD_parser(formatter.NullFormatter())
-        s=f.read()
-        h.feed(s)
-        f.close()
+        d['rem']=rem
+        return d
+
+    def fetch_data(self,starname,rem,sections=GCPD_parser.all_sections):
+        """ GCPD_parser fed with the response for starname, taken
+        from gcpd_mirror if it has it. Concurrent fetches of the same
+        query share one request and one parser, which callers must not
+        change.
+        """
+        d=self.query_params(starname,rem,sections)
+        key=(query_key(self.GCPD_action, d), tuple(sections))
+        return gcpd_single_flight.do(key, gcpd_retry.call, self.fetch_parsed,
+                                     d, sections)
+
+    def fetch_parsed(self,d,sections):
+        h = GCPD_parser(sections=sections)
+        body=None
+        if gcpd_mirror is not None:
+            body=gcpd_mirror.get(d['ident'],self.system_string,d['rem'])
+        if body is not None:
+            h.feed(body)
+        else:
+            feed_query(h, self.GCPD_action, d)
 
         return h
         
 
     def parse_data(self,column_names,lines):
-        
-        nph=len(lines)
-        splitlines=[l.split('\t') for l in lines]
-        d={}
-        for i in range(len(column_names)):
-            n=column_names[i].strip()
-            if len(n)>0:
-                data=[]
-                for j in range(nph):
-                    if len(splitlines[j])>=i+1:
-                        data.append(splitlines[j][i])
-                    else:
-                        data.append('')
-                d[n]=data
-                #this gets every i-th entry in all nonempty lines
-        return d
-        
-    def print_data(self,target,rem,references=True):
-        h=self.fetch_data(target,rem)        
-        photo_lines=[l  for l in h.photo_data.split('\n') if len(l.strip())>0]
-        data= self.parse_data( h.column_names, photo_lines)
-        d=self.process_data(data)
-        r=[ "# data in %s photometric system" % self.system_string]
-        for n in self.bands:
-            for M in d[n]:
-                if type(M)==types.FloatType:
-                    r.append("M   %s %s %s %.4g 0.05 # %s %s" %(target, self.system_common_name, n, M, self.system_common_name, n))
-        if references:
-            r.append('# References:')
-            r.append('#')
-            for ref in h.references:
+        return parse_table(column_names,lines,self.table_delimiter)
 
-                for k in ['Author', 'Journal', 'Title', 'BibcodeURL']:
-                    if k in ref:
-                        field=re.sub(r'\n|\t', ' ', ref[k],0)
-                        r.append('# ' + k +': ' + field)
-                r.append('#')
-            
-        return '\n'.join(r)
-        
-class _GCPD2:
-    ""
-    query_type    ='original'
-    GCPD_action="http://obswww.unige.ch/gcpd/cgi-bin/photoSys.cgi?"
-   
-    
-    def fetch_data(self,starname,rem):
-        d={}
-        d['phot']=self.system_string
-        d['type']=self.query_type                # as mean or ...
-        d['refer']='with'
-        d['ident']=translate_name(starname)
-        d['mode']='starno'
-        query = urllib.urlencode(d)+'&rem='+rem
-        op=urllib.URLopener().open
-        f=op(self.GCPD_action+query)
-        h = GCPD_parser(formatter.NullFormatter())
-        s=f.read()
-        h.feed(s)
-        f.close()
+    def process_columns(self,data,lists=True):
+        """ process_data on the columns of parse_data. With
+        gcpd_vectorized the columns are float arrays, NaN for missing
+        values, and the result is turned back into lists with '',
+        unless lists is False.
+        """
+        if gcpd_vectorized:
+            d=self.process_data(array_columns(data))
+            if lists:
+                d=list_columns(d)
+            return d
+        return self.process_data(data)
 
-        return h
-        
+    def process_data(self,d):
+        """ Bands from the columns d, as given by derivation """
+        return compile_derivation(self.derivation,self.bands).evaluate(d)
 
-    def parse_data(self,column_names,lines):
-        
-        nph=len(lines)
-        splitlines=[l.split() for l in lines]
-        d={}
-        for i in range(len(column_names)):
-            n=column_names[i].strip()
-            if len(n)>0:
-                data=[]
-                for j in range(nph):
-                    if len(splitlines[j])>=i+1:
-                        data.append(splitlines[j][i])
-                    else:
-                        data.append('')
-                d[n]=data
-                #this gets every i-th entry in all nonempty lines
-        return d
-        
-    def print_data(self,target,rem,references=True):
-        h=self.fetch_data(target,rem)
-        
+    def measurements(self,target,rem,references=False):
+        """ GCPD_measurements of target in this system, with the
+        references of the data if references is True.
+        """
+        sections=[GCPD_parser.DATA]
+        if references:
+            sections.append(GCPD_parser.REFERENCES)
+        h=self.fetch_data(target,rem,sections)
+        return self.parsed_measurements(h,target,rem)
+
+    def parsed_measurements(self,h,target,rem):
+        """ GCPD_measurements from h, the GCPD_parser of a query """
         photo_lines=[l  for l in h.photo_data.split('\n') if len(l.strip())>0]
-	del h.column_names[0]
         data= self.parse_data( h.column_names, photo_lines)
-        d=self.process_data(data)
-        r=[ "# data in %s photometric system" % self.system_string]
-        for n in self.bands:
-            for M in d[n]:
-                if type(M)==types.FloatType:
-                    r.append("M   %s %s %s %.4g 0.05 # %s %s" %(target, self.system_common_name, n, M, self.system_common_name, n))
+        d=self.process_columns(data,lists=False)
+        return GCPD_measurements(target, self.system_string,
+                                 self.system_common_name,
+                                 [(n,d[n]) for n in self.bands],
+                                 h.references, rem)
+        
+    def print_data(self,target,rem,references=True):
+        m=self.measurements(target,rem,references)
+        return self.format_data(m,references)
 
+    def format_data(self,m,references=True):
+        """ The text of print_data for the GCPD_measurements m """
+        target=m.target
+        r=[ "# data in %s photometric system" % self.system_string]
+        for n,M in m:
+            r.append("M   %s %s %s %.4g 0.05 # %s %s" %(target, self.system_common_name, n, M, self.system_common_name, n))
         if references:
             r.append('# References:')
             r.append('#')
-            for ref in h.references:
+            for ref in m.references:
 
                 for k in ['Author', 'Journal', 'Title', 'BibcodeURL']:
                     if k in ref:
@@ -456,6 +2355,11 @@ class _GCPD2:
             
         return '\n'.join(r)
         
+class _GCPD2(_GCPD):
+    """ Systems whose table rows are separated by whitespace, not tabs """
+    table_delimiter=None
+        
+
 class GCPD_Photometry_UBV(_GCPD):
     """ UBV photometry.
 
@@ -489,13 +2393,11 @@ class GCPD_Photometry_UBV(_GCPD):
     bands=list(system_string) # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        
-        V=[to_float(v) for v in d['V']]
-        B=[safe_add(v,bv) for v,bv in zip(V,d['B-V'])]
-        U=[safe_add(b,ub) for b,ub in zip(B,d['U-B'])]
-
-        return {'U':U,'B':B,'V':V}
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        U = B + [U-B]
+        """
 
 class GCPD_Photometry_UBVE(_GCPD):
     """ UBVE photometry.
@@ -506,12 +2408,11 @@ class GCPD_Photometry_UBVE(_GCPD):
     bands=list('UBV') # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        V=[to_float(v) for v in d['V']]
-        B=[safe_add(v,bv) for v,bv in zip(V,d['B-V'])]
-        U=[safe_add(b,ub) for b,ub in zip(B,d['U-B'])]
-
-        return {'U':U,'B':B,'V':V}
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        U = B + [U-B]
+        """
 
 class GCPD_Photometry_UBVRI(_GCPD):
     """ UBVRI photometry.
@@ -522,14 +2423,13 @@ class GCPD_Photometry_UBVRI(_GCPD):
     bands=list(system_string) # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        V=[to_float(v) for v in d['V']]
-        B=[safe_add(v,bv) for v,bv in zip(V,d['B-V'])]
-        U=[safe_add(b,ub) for b,ub in zip(B,d['U-B'])]
-        R=[safe_sub(v,vr) for v,vr in zip(V,d['V-R'])]
-        I=[safe_sub(r,ri) for r,ri in zip(R,d['R-I'])]
-
-        return {'U':U,'B':B,'V':V,'R':R,'I':I}
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        U = B + [U-B]
+        R = V - [V-R]
+        I = R - [R-I]
+        """
 
 class GCPD_Photometry_IJHKLMN(_GCPD):
     """ IJHKLMN photometry.
@@ -540,15 +2440,14 @@ class GCPD_Photometry_IJHKLMN(_GCPD):
     bands=list('JHKLMN') # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        J=[to_float(j) for j in d['J']]
-        H=[to_float(h) for h in d['H']]
-        K=[to_float(k) for k in d['K']]
-        L=[to_float(l) for l in d['L']]
-        M=[to_float(m) for m in d['M']]
-        N=[to_float(n) for n in d['N']]
-
-        return {'J':J,'H':H,'K':K,'L':L,'M':M,'N':N}
+    derivation="""
+        J = [J]
+        H = [H]
+        K = [K]
+        L = [L]
+        M = [M]
+        N = [N]
+        """
 
 class GCPD_Photometry_RI_Eggen(_GCPD):
     """ (RI)Eggen photometry.
@@ -559,19 +2458,11 @@ class GCPD_Photometry_RI_Eggen(_GCPD):
     bands=list('VRI') # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        
-        V=[to_float(v) for v in d['V']]
-        R=[safe_sub(v,vr) for v,vr in zip(V,d['V-R'])]
-        for e in range(len(R)):
-            if R[e] == '':
-                R[e]=[to_float(r) for r in d['R']][e]
-        I=[safe_sub(r,ri) for r,ri in zip(R,d['R-I'])]
-        for e in range(len(I)):
-            if I[e] == '':
-                I[e]=[to_float(i) for i in d['I']][e]
-                
-        return {'V':V,'R':R,'I':I}
+    derivation="""
+        V = [V]
+        R = V - [V-R] | [R]
+        I = R - [R-I] | [I]
+        """
 
 class GCPD_Photometry_UBV_CAPE(_GCPD):
     """ UBV Cape photometry.
@@ -581,11 +2472,11 @@ class GCPD_Photometry_UBV_CAPE(_GCPD):
    
     bands=list('UBV') # this gives standard ordering of bands,
 
-    def process_data(self,d):
-        V=[to_float(v) for v in d['V']]
-        B=[safe_add(v,bv) for v,bv in zip(V,d['B-V'])]
-        U=[safe_add(b,ub) for b,ub in zip(B,d['Uc-B'])]
-        return {'V':V,'B':B,'U':U}
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        U = B + [Uc-B]
+        """
 
 class GCPD_Photometry_RI_Cousins(_GCPD):
     """ (RI)Cousins photometry.
@@ -595,14 +2486,13 @@ class GCPD_Photometry_RI_Cousins(_GCPD):
    
     bands=list('UBVRI') # this gives standard ordering of bands,
                               # useful for testing
-    def process_data(self,d):
-        V=[to_float(v) for v in d['V']]
-        B=[safe_add(v,bv) for v,bv in zip(V,d['B-V'])]
-        U=[safe_add(b,ub) for b,ub in zip(B,d['U-B'])]
-        I=[safe_sub(v,vi) for v,vi in zip(V,d['V-I'])]
-        R=[safe_add(i,ri) for i,ri in zip(I,d['R-I'])]
-        #return {'V':V}
-        return {'U':U,'B':B,'V':V,'R':R,'I':I}
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        U = B + [U-B]
+        I = V - [V-I]
+        R = I + [R-I]
+        """
 
 class GCPD_Photometry_RI_Kron(_GCPD):
     """ (RI)Kron photometry.
@@ -613,19 +2503,11 @@ class GCPD_Photometry_RI_Kron(_GCPD):
     bands=list('VRI') # this gives standard ordering of bands,
                               # useful for testing
 
-    def process_data(self,d):
-        
-        V=[to_float(v) for v in d['V']]
-        R=[safe_sub(v,vr) for v,vr in zip(V,d['V-R'])]
-        for e in range(len(R)):
-            if R[e] == '':
-                R[e]=[to_float(r) for r in d['R']][e]
-        I=[safe_sub(r,ri) for r,ri in zip(R,d['R-I'])]
-        for e in range(len(I)):
-            if I[e] == '':
-                I[e]=[to_float(i) for i in d['I']][e]
-
-        return {'V':V,'R':R,'I':I}
+    derivation="""
+        V = [V]
+        R = V - [V-R] | [R]
+        I = R - [R-I] | [I]
+        """
 
 class GCPD_Photometry_Vilnius(_GCPD):
     """ Vilnius photometry.
@@ -654,20 +2536,18 @@ class GCPD_Photometry_Vilnius(_GCPD):
     system_string='Vilnius'
     system_common_name='Vilnius'
    
-    bands=list('UPXYZVS') # this gives standard ordering of bands,
-                         # useful for testing
-
-    def process_data(self,d):
-        
-        V=[to_float(v) for v in d['V']]
-        S=[safe_sub(v,vs) for v,vs in zip(V,d['V-S'])]
-        Z=[safe_add(v,zv) for v,zv in zip(V,d['Z-V'])]
-        Y=[safe_add(z,yz) for z,yz in zip(Z,d['Y-Z'])]
-        X=[safe_add(y,xy) for y,xy in zip(Y,d['X-Y'])]
-        P=[safe_add(x,px) for x,px in zip(X,d['P-X'])]
-        U=[safe_add(p,up) for p,up in zip(P,d['U-P'])]
+    bands=list('UPXYZVS') # this gives standard ordering of bands,
+                         # useful for testing
 
-        return dict([(k,locals()[k]) for k in self.bands])
+    derivation="""
+        V = [V]
+        S = V - [V-S]
+        Z = V + [Z-V]
+        Y = Z + [Y-Z]
+        X = Y + [X-Y]
+        P = X + [P-X]
+        U = P + [U-P]
+        """
 
 class GCPD_Photometry_Straizys(GCPD_Photometry_Vilnius):
     """ Straizis photometry.
@@ -699,27 +2579,17 @@ class GCPD_Photometry_ubvy(_GCPD):
     system_common_name='Stromgren'
     bands=['u', 'b', 'v', 'y', 'beta']
     
-    def process_data(self,d):
-        #m1-(v-b)-(b-y)
-        #c1=(u-v)-(v-b)
-        y=[to_float(vv) for vv in d['V']]
-        m1=[to_float(mm) for mm in d['m1']]
-        c1=[to_float(cc) for cc in d['c1']]
-        b_m_y=[to_float(mm) for mm in d['b-y']]
-
-        b=[safe_add(vv,bmy) for vv,bmy in zip(y,b_m_y)]
- 
-        v2=[safe_add(bb2,mm2) for bb2,mm2 in zip(b,m1)]
-        v1=[safe_sub(bb1,y1) for bb1,y1 in zip(b,y)]
-        v=[safe_add(vv1,vv2) for vv1,vv2 in zip(v1,v2)]
-
-        u2=[safe_add(cc1,vv3) for cc1,vv3 in zip(c1,v)]
-        u1=[safe_sub(vv4,bb3) for vv4,bb3 in zip(v,b)]
-        u=[safe_add(uu1,uu2) for uu1,uu2 in zip(u1,u2)]
-
-        beta=[to_float(bb) for bb in d['beta']]
-       
-        return dict([(k,locals()[k]) for k in self.bands])
+    derivation="""
+        y = [V]
+        b = y + [b-y]
+        _v1 = b - y
+        _v2 = b + [m1]
+        v = _v1 + _v2
+        _u1 = v - b
+        _u2 = [c1] + v
+        u = _u1 + _u2
+        beta = [beta]
+        """
 
 class GCPD_Photometry_Geneva(_GCPD):
     """ Geneva photometry.
@@ -743,16 +2613,15 @@ class GCPD_Photometry_Geneva(_GCPD):
     bands=['V', 'B', 'U', 'B1', 'B2', 'V1', 'G']
     
   
-    def process_data(self,d):
-        V=[to_float(v) for v in d['VM']]
-        B=[safe_sub(v,bv) for v,bv in zip(V,d['V'])]
-        U=[safe_add(bv,ub) for bv,ub in zip(B,d['U'])]
-        B1=[safe_add(b1,bv) for b1,bv in zip(B,d['B1'])]
-        B2=[safe_add(b2,bv) for b2,bv in zip(B,d['B2'])]
-        V1=[safe_add(v1,bv) for v1,bv in zip(B,d['V1'])]
-        G=[safe_add(g,bv) for g,bv in zip(B,d['G'])]
-
-        return {'U':U,'B':B,'V':V,'B1':B1,'B2':B2,'V1':V1,'G':G}
+    derivation="""
+        V = [VM]
+        B = V - [V]
+        U = B + [U]
+        B1 = B + [B1]
+        B2 = B + [B2]
+        V1 = B + [V1]
+        G = B + [G]
+        """
 
 
     
@@ -775,15 +2644,14 @@ class GCPD_Photometry_Walraven(_GCPD):
     system_common_name='Walraven'
     bands=list('VBLUW')
     #bands=['V', 'B', 'L','U','W']
-    def process_data(self,d):
-        V=[to_float(s) for s in d['V']]
-        B=[safe_add(v,vb) for v,vb in zip(V,d['V-B'])]
-        U=[safe_sub(b,bu) for b,bu in zip(B,d['B-U'])]
-        W=[safe_sub(u,uw) for u,uw in zip(U,d['U-W'])]
-        L=[safe_sub(b,bl) for b,bl in zip(B,d['B-L'])]
-        VJ=[to_float(s) for s in d['VJ']]
-        return {'V':V,'B':B,'U':U,'W':W,'L':L,'VJ':VJ}
-        """return dict([(k,locals()[k]) for k in self.bands])"""
+    derivation="""
+        V = [V]
+        B = V + [V-B]
+        U = B - [B-U]
+        W = U - [U-W]
+        L = B - [B-L]
+        VJ = [VJ]
+        """
     
 class GCPD_Photometry_DDO(_GCPD):
     """ DDO photometry.
@@ -803,16 +2671,15 @@ class GCPD_Photometry_DDO(_GCPD):
     system_common_name='DDO'
     bands=['m48', 'm51', 'm45', 'm42', 'm41', 'm38', 'm35']
 
-    def process_data(self,d):
-        V48=[to_float(s) for s in d['V48']]
-        V51=sub_list(V48, d['C4851'])
-        V45=add_list(V48, d['C4548'])
-        V42=add_list(V45, d['C4245'])
-        V41=add_list(V42, d['C4142'])
-        V38=add_list(V41, d['C3841'])
-        V35=add_list(V38, d['C3538'])
-        
-        return dict([(b,locals()['V'+string.lstrip(b,'m')]) for b in self.bands])
+    derivation="""
+        m48 = [V48]
+        m51 = m48 - [C4851]
+        m45 = m48 + [C4548]
+        m42 = m45 + [C4245]
+        m41 = m42 + [C4142]
+        m38 = m41 + [C3841]
+        m35 = m38 + [C3538]
+        """
 
 class GCPD_Photometry_Oja(_GCPD):
     """ Oja photometry.
@@ -821,13 +2688,11 @@ class GCPD_Photometry_Oja(_GCPD):
     system_common_name='Oja'
     bands=['m45', 'm42', 'm41']
 
-    def process_data(self,d):
-
-        M45=[to_float(s) for s in d['m45']]
-        M42=add_list(M45, d['ge'])
-        M41=add_list(M42, d['ce'])
-        
-        return dict([(b,locals()['M'+string.lstrip(b,'m')]) for b in self.bands])
+    derivation="""
+        m45 = [m45]
+        m42 = m45 + [ge]
+        m41 = m42 + [ce]
+        """
 
 class GCPD_Photometry_13_color(_GCPD):
     """ 13-color photometry.
@@ -836,22 +2701,22 @@ class GCPD_Photometry_13_color(_GCPD):
     system_common_name='13-color'
     bands=['m52','m33','m35','m37','m40','m45','m63','m58','m72','m80','m86','m99','m110']
     
-    def process_data(self,d):
-        M52=[to_float(s) for s in d['52']]
-        M33=add_list(M52, d['33-52'])
-        M35=add_list(M52, d['35-52'])
-        M37=add_list(M52, d['37-52'])
-        M40=add_list(M52, d['40-52'])
-        M45=add_list(M52, d['45-52'])
-        M52=add_list(M52, d['52-52'])
-        M63=add_list(M52, d['63-52'])
-        M58=add_list(M52, d['58-52'])
-        M72=sub_list(M58, d['72-58'])
-        M80=sub_list(M58, d['80-58'])
-        M86=sub_list(M58, d['86-58'])
-        M99=sub_list(M58, d['99-58'])
-        M110=sub_list(M58, d['110-58'])
-        return dict([(b,locals()['M'+string.lstrip(b,'m')]) for b in self.bands])
+    derivation="""
+        _m52 = [52]
+        m33 = _m52 + [33-52]
+        m35 = _m52 + [35-52]
+        m37 = _m52 + [37-52]
+        m40 = _m52 + [40-52]
+        m45 = _m52 + [45-52]
+        m52 = _m52 + [52-52]
+        m63 = m52 + [63-52]
+        m58 = m52 + [58-52]
+        m72 = m58 - [72-58]
+        m80 = m58 - [80-58]
+        m86 = m58 - [86-58]
+        m99 = m58 - [99-58]
+        m110 = m58 - [110-58]
+        """
 
 
 class GCPD_Photometry_Alexander(_GCPD2):
@@ -862,13 +2727,12 @@ class GCPD_Photometry_Alexander(_GCPD2):
     system_common_name='Alexander'
     bands=['m746','m608','m683','m710']
 
-    def process_data(self,d):
-        M746=[to_float(s) for s in d['7460']]
-        M608=add_list(M746, d['6076-7460'])
-        M710=add_list(M746, d['7100-7460'])
-        M683=add_list(M710, d['6830-7100'])
-        
-        return dict([(b,locals()['M'+string.lstrip(b,'m')]) for b in self.bands])
+    derivation="""
+        m746 = [7460]
+        m608 = m746 + [6076-7460]
+        m710 = m746 + [7100-7460]
+        m683 = m710 + [6830-7100]
+        """
 
 
 class GCPD_Photometry_WBVR(_GCPD):
@@ -890,13 +2754,12 @@ class GCPD_Photometry_WBVR(_GCPD):
     system_common_name='WBVR'
     bands=list('WBVR')
 
-    def process_data(self,d):
-
-        V=[to_float(s) for s in d['V']]
-        B=add_list(V, d['B-V'])
-        W=add_list(B, d['W-B'])
-        R=sub_list(V, d['V-R'])
-        return dict([(b,locals()[b]) for b in self.bands])
+    derivation="""
+        V = [V]
+        B = V + [B-V]
+        W = B + [W-B]
+        R = V - [V-R]
+        """
 
 
 
@@ -919,14 +2782,13 @@ class GCPD_Photometry_Washington(_GCPD):
     system_common_name='Washington'
     bands=['V', 'C', 'M','T1', 'T2']  #M51?
 
-    def process_data(self,d):
-        V=[to_float(s) for s in d['V']]
-        T1=sub_list(V, d['V-T1'])
-        M=add_list(T1, d['M-T1'])
-        C=add_list(M, d['C-M'])
-        T2=sub_list(T1, d['T1-T2'])
-        M51=[to_float(s) for s in d['M51']]
-        return dict([(b,locals()[b]) for b in self.bands])
+    derivation="""
+        V = [V]
+        T1 = V - [V-T1]
+        M = T1 + [M-T1]
+        C = M + [C-M]
+        T2 = T1 - [T1-T2]
+        """
 
 
 photo_translate_name={'(RI)Cousins':'RI_Cousins',
@@ -947,6 +2809,1259 @@ PHOTOMETRY_classes=dict([(translate_photo_name(_class.system_string),_class)
 
 supported_systems = PHOTOMETRY_classes.keys()
 
+# check the derivations of all systems when the module is loaded
+for _class in PHOTOMETRY_classes.values():
+    compile_derivation(_class.derivation,_class.bands)
+
+class GCPD_availability_index:
+    """ Index of the supported photometric systems that have data for
+    each star, built from one genIndex.cgi query per star code and
+    kept for reuse. Concurrent lookups of one star share one query.
+    At most max_stars stars are kept, an arbitrary one is dropped to
+    make room for a new one.
+    """
+    def __init__(self, max_stars=10000):
+        self.stars={}
+        self.max_stars=max_stars
+        self.lock=threading.Lock()
+        self.queries=GCPD_single_flight()
+
+    def lookup(self,starname,rem=''):
+        """ Names of PHOTOMETRY_classes with data for starname, in
+        the order genIndex.cgi lists them.
+        """
+        try:
+            l=GCPD_system_list(starname,rem)
+        except GCPD_No_Data:
+            return ()
+        return tuple([translate_photo_name(n) for n in l
+                      if translate_photo_name(n) in PHOTOMETRY_classes])
+
+    def available(self,starname,rem=''):
+        """ Like lookup, but each star is only queried once.
+        If the query fails, its exception is raised in every caller
+        waiting for it and the star is queried again next time.
+        """
+        code=star_code(starname)
+        with self.lock:
+            if code in self.stars:
+                return self.stars[code]
+        systems=self.queries.do(code, self.lookup, starname, rem)
+        with self.lock:
+            if len(self.stars)>=self.max_stars:
+                self.stars.popitem()
+            self.stars[code]=systems
+        return systems
+
+    def has_data(self,starname,ph,rem=''):
+        """ False only if the index says starname has no data in ph """
+        try:
+            return ph in self.available(starname,rem)
+        except IOError:
+            return True
+
+io_error_prefix="# IOEror  "
+
+def io_error_message(k):
+    return io_error_prefix + "  ---  ".join([str(a) for a in k.args[:2]])
+
+GCPD_measurement=collections.namedtuple('GCPD_measurement',
+                                        'target system band value')
+GCPD_reference=collections.namedtuple('GCPD_reference',
+                                      'target system author journal title '
+                                      'bibcode_url')
+
+def iter_measurements(target,systems=None,rem='',references=False):
+    """ Yield GCPD_measurement records of target in each of systems,
+    all supported systems by default, followed by GCPD_reference
+    records of each system if references is True. A system is only
+    queried once the records of the one before are consumed, systems
+    without data yield nothing.
+    """
+    if systems is None:
+        systems=supported_systems
+    for ph in systems:
+        try:
+            m=PHOTOMETRY_classes[ph]().measurements(target,rem,references)
+        except GCPD_No_Data:
+            continue
+        for record in m.records():
+            yield record
+
+def format_record(record):
+    """ A GCPD_measurement or GCPD_reference as one tab separated line,
+    starting with M or R. Values are given with full precision.
+
+    >>> format_record(GCPD_measurement('HD1', 'UBV', 'V', 6.38)).split('\\t')
+    ['M', 'HD1', 'UBV', 'V', '6.38']
+    """
+    if isinstance(record,GCPD_measurement):
+        fields=['M']+list(record[:3])+[repr(record.value)]
+    else:
+        fields=['R']+[re.sub(r'\s', ' ', f or '') for f in record]
+    return '\t'.join(fields)
+
+def json_string(s):
+    """ s as a JSON string, s may be utf-8 or latin-1 encoded """
+    try:
+        return json.dumps(s)
+    except UnicodeDecodeError:
+        return json.dumps(s.decode('latin-1'))
+
+class GCPD_text_writer:
+    """ Output writer for the tab separated lines of format_record.
+    Each system is flushed as soon as it is written.
+    Output writers take GCPD_measurements with write(), query messages
+    with message(), and finish the output with close(). start() begins
+    an output that is not appended to an earlier one.
+    """
+    def __init__(self,f):
+        self.f=f
+
+    def start(self):
+        pass
+
+    def write(self,m):
+        self.f.writelines([format_record(r)+'\n' for r in m.records()])
+        self.f.flush()
+
+    def message(self,msg):
+        print >>self.f, msg
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+
+class GCPD_jsonl_writer(GCPD_text_writer):
+    """ Output writer for JSON Lines, one object per record, e.g.
+
+    {"record": "M", "target": "HD1", "system": "UBV", "band": "V", "value": 6.38}
+
+    and for references, with null for missing fields,
+
+    {"record": "R", "target": ..., "system": ..., "author": ...,
+     "journal": ..., "title": ..., "bibcode_url": ...}
+
+    Messages go to stderr.
+    """
+    def write(self,m):
+        system=translate_photo_name(m.system)
+        head='{"record": "M", "target": %s, "system": %s, "band": ' % (
+            json_string(m.target), json_string(system))
+        lines=[]
+        for band in m.bands:
+            prefix='%s%s, "value": ' % (head, json_string(band))
+            lines.extend([prefix+repr(v)+'}\n' for v in
+                          itertools.compress(m.values[band], m.masks[band])])
+        for r in m.reference_records():
+            fields=[('record','R')]+zip(r._fields,r)
+            lines.append('{%s}\n' % ', '.join(['"%s": %s' %
+                (k, v is None and 'null' or json_string(v))
+                for k,v in fields]))
+        self.f.writelines(lines)
+
+    def message(self,msg):
+        print >>sys.stderr, msg
+
+class GCPD_csv_writer(GCPD_jsonl_writer):
+    """ Output writer for CSV with a target,system,band,value header.
+    References are left out, messages go to stderr.
+    """
+    def __init__(self,f):
+        self.f=f
+        self.writer=csv.writer(f, lineterminator='\n')
+
+    def start(self):
+        self.writer.writerow(GCPD_measurement._fields)
+
+    def write(self,m):
+        system=translate_photo_name(m.system)
+        for band in m.bands:
+            self.writer.writerows([(m.target,system,band,v) for v in
+                itertools.compress(m.values[band], m.masks[band])])
+
+class GCPD_npz_writer(GCPD_jsonl_writer):
+    """ Output writer for a NumPy .npz file, written on close().
+    The measurements are the equal length arrays target, system, band
+    and value; the references are ref_target, ref_system, ref_author,
+    ref_journal, ref_title and ref_bibcode_url, with '' for missing
+    fields. Names are kept as integer codes until close().
+    Messages go to stderr.
+
+    >>> import StringIO
+    >>> f=StringIO.StringIO()
+    >>> w=GCPD_npz_writer(f)
+    >>> w.write(GCPD_measurements('HD1', 'UBV', 'Johnson',
+    ...                           [('V', [6.5, '', 6.25])]))
+    >>> w.close()
+    >>> d=numpy.load(StringIO.StringIO(f.getvalue()))
+    >>> d['band'].tolist(), d['value'].tolist()
+    (['V', 'V'], [6.5, 6.25])
+    """
+    def __init__(self,f):
+        self.f=f
+        self.columns={}
+        self.codes={}
+        self.names={}
+        for k in ('target','system','band'):
+            self.columns[k]=array.array('i')
+            self.codes[k]={}
+            self.names[k]=[]
+        self.value=array.array('d')
+        self.references=[]
+
+    def code(self,column,name):
+        codes=self.codes[column]
+        if name not in codes:
+            codes[name]=len(codes)
+            self.names[column].append(name)
+        return codes[name]
+
+    def write(self,m):
+        target=self.code('target',m.target)
+        system=self.code('system',translate_photo_name(m.system))
+        for band in m.bands:
+            n=len(self.value)
+            self.value.extend(itertools.compress(m.values[band],
+                                                 m.masks[band]))
+            n=len(self.value)-n
+            self.columns['target'].extend([target]*n)
+            self.columns['system'].extend([system]*n)
+            self.columns['band'].extend([self.code('band',band)]*n)
+        self.references.extend(m.reference_records())
+
+    def close(self):
+        d={'value':numpy.frombuffer(self.value,float)}
+        for k,codes in self.columns.items():
+            names=numpy.array(self.names[k] or [''])
+            d[k]=names[numpy.frombuffer(codes,numpy.intc)]
+        for i,k in enumerate(GCPD_reference._fields):
+            d['ref_'+k]=numpy.array([r[i] or '' for r in self.references]
+                                    or [''])[:len(self.references)]
+        numpy.savez(self.f,**d)
+        self.f.flush()
+
+# output writers of --format
+output_formats={'text':GCPD_text_writer,
+                'jsonl':GCPD_jsonl_writer,
+                'csv':GCPD_csv_writer,
+                'npz':GCPD_npz_writer}
+
+class GCPD_store:
+    """ Indexed SQLite store of measurements and their references.
+    A unit, the data of one star in one system for one rem code, is
+    keyed by its star_code, so HD1 and HDE1 are the same star. Storing
+    a unit again replaces it. Units are written in batches of
+    batch_size, each batch in one transaction, flush() or close()
+    writes the rest.
+
+    >>> s=GCPD_store(':memory:')
+    >>> s.put(GCPD_measurements('HD1', 'UBV', 'Johnson',
+    ...                         [('U', ['']), ('B', ['']), ('V', [6.5])]))
+    >>> [list(m) for m in s.measurements(['HDE1'], ['UBV'], ['V'])]
+    [[('V', 6.5)]]
+    >>> s.stars_with_data(['UBV'])
+    ['HD1']
+    """
+    def __init__(self, path, batch_size=500):
+        self.batch_size=batch_size
+        self.pending=[]
+        self.db=sqlite3.connect(path, timeout=60)
+        self.db.text_factory=str  # names and references as read from GCPD
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS units
+                               (star TEXT, rem TEXT, system TEXT,
+                                target TEXT, rows INTEGER,
+                                magnitudes INTEGER, stored REAL,
+                                PRIMARY KEY (star, rem, system))""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS units_system
+                               ON units (system, star)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS measurements
+                               (star TEXT, rem TEXT, system TEXT,
+                                band TEXT, row INTEGER, value REAL,
+                                PRIMARY KEY (star, rem, system, band, row))""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS measurements_band
+                               ON measurements (system, band)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS refs
+                               (star TEXT, rem TEXT, system TEXT,
+                                position INTEGER, author TEXT,
+                                journal TEXT, title TEXT, bibcode_url TEXT,
+                                PRIMARY KEY (star, rem, system, position))""")
+
+    def put(self, m):
+        """ Store GCPD_measurements m """
+        self.pending.append(m)
+        if len(self.pending)>=self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pending,self.pending=self.pending,[]
+        now=time.time()
+        with self.db:
+            for m in pending:
+                key=(star_code(m.target), m.rem,
+                     translate_photo_name(m.system))
+                for table in ('measurements', 'refs'):
+                    self.db.execute('DELETE FROM %s WHERE star=? AND rem=? '
+                                    'AND system=?' % table, key)
+                rows=0
+                for band in m.bands:
+                    rows=len(m.values[band])
+                    self.db.executemany(
+                        'INSERT INTO measurements VALUES (?,?,?,?,?,?)',
+                        [key+(band,row,value) for row,value in
+                         enumerate(m.values[band]) if m.masks[band][row]])
+                self.db.execute('INSERT OR REPLACE INTO units VALUES '
+                                '(?,?,?,?,?,?,?)',
+                                key+(m.target, rows, len(m), now))
+                self.db.executemany('INSERT INTO refs VALUES (?,?,?,?,?,?,?,?)',
+                                    [key+(i,)+tuple(r[2:]) for i,r in
+                                     enumerate(m.reference_records())])
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def measurements(self, targets=None, systems=None, bands=None):
+        """ Yield stored GCPD_measurements of the stars of targets, for
+        every rem code, in systems, with only the given bands.
+        None stands for all of them.
+        """
+        self.flush()
+        where,params=[],[]
+        if targets is not None:
+            self.wanted(targets)
+            where.append('star IN (SELECT star FROM temp.wanted)')
+        if systems is not None:
+            where.append('system IN (%s)' % ','.join('?'*len(systems)))
+            params.extend(systems)
+        query='SELECT star, rem, system, target, rows FROM units'
+        if where:
+            query+=' WHERE '+' AND '.join(where)
+        units=self.db.execute(query+' ORDER BY star, system, rem',
+                              params).fetchall()
+        for star,rem,system,target,rows in units:
+            cl=PHOTOMETRY_classes.get(system)
+            if cl is None:
+                continue
+            columns=[]
+            for band in cl.bands:
+                if bands is not None and band not in bands:
+                    continue
+                column=['']*rows
+                for row,value in self.db.execute(
+                    'SELECT row, value FROM measurements WHERE star=? AND '
+                    'rem=? AND system=? AND band=?',
+                    (star,rem,system,band)):
+                    column[row]=value
+                columns.append((band,column))
+            references=[]
+            for fields in self.db.execute(
+                'SELECT author, journal, title, bibcode_url FROM refs '
+                'WHERE star=? AND rem=? AND system=? ORDER BY position',
+                (star,rem,system)):
+                references.append(dict([(k,v) for k,v in
+                    zip(['Author','Journal','Title','BibcodeURL'],fields)
+                    if v is not None]))
+            yield GCPD_measurements(target, cl.system_string,
+                                    cl.system_common_name, columns,
+                                    references, rem)
+
+    def stars_with_data(self, systems):
+        """ Targets with magnitudes in every one of systems """
+        self.flush()
+        return [target for target, in self.db.execute(
+            'SELECT MIN(target) FROM units WHERE system IN (%s) AND '
+            'magnitudes>0 GROUP BY star HAVING COUNT(DISTINCT system)=? '
+            'ORDER BY star' % ','.join('?'*len(systems)),
+            list(systems)+[len(set(systems))])]
+
+    def wanted(self, targets):
+        """ Fill the temporary table of wanted star codes """
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted '
+                            '(star TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM temp.wanted')
+            self.db.executemany('INSERT OR IGNORE INTO temp.wanted VALUES (?)',
+                                [(star_code(t),) for t in targets])
+
+class GCPD_journal:
+    """ Work table of a batch run in an SQLite file: each finished
+    (system, target, rem) unit with its state, 'done' or 'failed',
+    the number of times it was run and its last message.
+
+    Units are recorded in memory and written by checkpoint() in one
+    transaction, with the length of the output written for them. A run
+    started again with resume cuts the output back to that length and
+    only runs the units not done, and the failed ones that were run
+    less than max_attempts times. Without resume the journal starts
+    empty.
+
+    >>> j=GCPD_journal(':memory:')
+    >>> j.record(('UBV', 'HD1', ''), 'data')
+    >>> j.record(('UBV', 'HD2', ''), io_error_message(IOError('x')))
+    >>> j.checkpoint(120)
+    >>> j.wanted(('UBV', 'HD1', '')), j.wanted(('UBV', 'HD2', ''))
+    (False, True)
+    >>> j.offset, sorted(j.counts().items())
+    (120, [('done', 1), ('failed', 1)])
+    """
+    def __init__(self, path, resume=False, max_attempts=3):
+        self.max_attempts=max_attempts
+        self.pending=[]
+        self.db=sqlite3.connect(path, timeout=60)
+        self.db.text_factory=str
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS units
+                               (system TEXT, target TEXT, rem TEXT,
+                                state TEXT, attempts INTEGER,
+                                message TEXT, updated REAL,
+                                PRIMARY KEY (system, target, rem))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS checkpoint
+                               (id INTEGER PRIMARY KEY, offset INTEGER)""")
+            if not resume:
+                self.db.execute('DELETE FROM units')
+                self.db.execute('DELETE FROM checkpoint')
+        self.units=dict([((system,target,rem),(state,attempts)) for
+                         system,target,rem,state,attempts in
+                         self.db.execute('SELECT system, target, rem, state, '
+                                         'attempts FROM units')])
+        row=self.db.execute('SELECT offset FROM checkpoint').fetchone()
+        self.offset=row and row[0] or 0
+
+    def wanted(self, unit):
+        """ False if unit need not be run again """
+        state,attempts=self.units.get(tuple(unit), (None, 0))
+        return (state is None or
+                state=='failed' and attempts<self.max_attempts)
+
+    def record(self, unit, result):
+        """ Record that unit was run with result, as given by
+        system_data; it failed if the result is an io_error_message.
+        """
+        unit=tuple(unit)
+        failed=isinstance(result,str) and result.startswith(io_error_prefix)
+        state=failed and 'failed' or 'done'
+        attempts=self.units.get(unit, (None, 0))[1]+1
+        self.units[unit]=state,attempts
+        self.pending.append(unit+(state, attempts,
+                                  failed and result or None, time.time()))
+
+    def checkpoint(self, offset=None):
+        """ Write the recorded units, and the output length offset """
+        pending,self.pending=self.pending,[]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO units VALUES '
+                                '(?,?,?,?,?,?,?)', pending)
+            if offset is not None:
+                self.db.execute('INSERT OR REPLACE INTO checkpoint '
+                                'VALUES (0,?)', (offset,))
+                self.offset=offset
+
+    def counts(self):
+        """ Number of units in each state """
+        counts={}
+        for state,attempts in self.units.values():
+            counts[state]=counts.get(state, 0)+1
+        return counts
+
+    def close(self):
+        """ Closes the journal; units recorded since the last
+        checkpoint are not kept.
+        """
+        self.db.close()
+
+def harvest_mirror(path, units, jobs=4):
+    """ Fetch the photoSys.cgi responses of units, (system, target, rem)
+    tuples, into the GCPD_mirror in directory path, which is created if
+    needed. Units already in the mirror are fetched again and replaced,
+    their old bodies stay in the data file. Yields a message for every
+    unit that could not be harvested, the index is written at the end.
+
+    >>> import tempfile, shutil
+    >>> path=tempfile.mkdtemp()
+    >>> list(harvest_mirror(path, [('UBV', 'Nova', '')]))
+    ['# star Nova cannot be mirrored']
+    >>> GCPD_mirror(path).get('0100000001', 'UBV')
+    >>> shutil.rmtree(path)
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    entries={}
+    if os.path.exists(os.path.join(path, 'index')):
+        entries=GCPD_mirror(path).entries()
+    validators=GCPD_mirror.read_validators(path)
+    def fetch(u):
+        ph,target,rem=u
+        cl=PHOTOMETRY_classes[ph]
+        key=GCPD_mirror.pack_key(star_code(target), cl.system_string,
+                                 rem.strip())
+        if key is None:
+            return "# star %s cannot be mirrored" % target
+        params=cl().query_params(target, rem, GCPD_parser.all_sections)
+        try:
+            body,etag,modified=gcpd_retry.call(conditional_read,
+                cl.GCPD_action+urllib.urlencode(params))
+        except IOError,k:
+            return io_error_message(k)
+        return key, zlib.compress(body), (etag, modified)
+    data=open(os.path.join(path, 'data'), 'ab')
+    try:
+        data.seek(0, 2)
+        for r in thread_map(fetch, units, jobs, False):
+            if isinstance(r, str):
+                yield r
+                continue
+            key,body,validators[key]=r
+            entries[key]=(data.tell(), len(body))
+            data.write(body)
+        data.flush()
+        os.fsync(data.fileno())
+    finally:
+        data.close()
+    GCPD_mirror.write_index(path, entries)
+    GCPD_mirror.write_validators(path, validators)
+
+def refresh_mirror(path, jobs=4):
+    """ Revalidate every response of the GCPD_mirror in directory path
+    with conditional requests, jobs at a time, and compare the bodies
+    the server sends with the mirrored ones. Only changed bodies are
+    appended and indexed again. Yields a message for every changed
+    body and every failed request, and a summary at the end.
+    """
+    mirror=GCPD_mirror(path)
+    entries=mirror.entries()
+    validators=GCPD_mirror.read_validators(path)
+    classes=dict([(cl.system_string, cl) for cl in PHOTOMETRY_classes.values()])
+    def unit(key):
+        return [f.rstrip('\0') for f in GCPD_mirror.key.unpack(key)]
+    def revalidate(key):
+        code,system,rem=unit(key)
+        cl=classes[system]
+        url=cl.GCPD_action+urllib.urlencode(cl().query_params(code, rem))
+        etag,modified=validators.get(key, (None, None))
+        try:
+            return key, gcpd_retry.call(conditional_read, url, None, etag,
+                                        modified)
+        except IOError,k:
+            return key, k
+    counts={'changed':0, 'not modified':0, 'same':0, 'failed':0}
+    data=open(os.path.join(path, 'data'), 'ab')
+    try:
+        data.seek(0, 2)
+        for key,r in thread_map(revalidate, entries.keys(), jobs, False):
+            if isinstance(r, IOError):
+                counts['failed']+=1
+                yield io_error_message(r)
+                continue
+            body,etag,modified=r
+            validators[key]=(etag, modified)
+            if body is None:
+                counts['not modified']+=1
+                continue
+            offset,length=entries[key]
+            if zlib.decompress(mirror.data[offset:offset+length])==body:
+                counts['same']+=1
+                continue
+            counts['changed']+=1
+            body=zlib.compress(body)
+            entries[key]=(data.tell(), len(body))
+            data.write(body)
+            yield '# changed %s' % ' '.join([f for f in unit(key) if f])
+        data.flush()
+        os.fsync(data.fileno())
+    finally:
+        data.close()
+    if counts['changed']:
+        GCPD_mirror.write_index(path, entries)
+    GCPD_mirror.write_validators(path, validators)
+    yield ('# refreshed %d mirror entries: %d changed, %d not modified, '
+           '%d same, %d failed' % (len(entries), counts['changed'],
+           counts['not modified'], counts['same'], counts['failed']))
+
+def unit_message(ph,target,e):
+    """ What system_data reports for e, one of unit_errors """
+    if isinstance(e,IOError):
+        return io_error_message(e)
+    if isinstance(e,StarNameException):
+        return "# star %s not found"% target
+    return "# No data for star %s in photosystem %s"% (target,ph)
+
+unit_errors=(IOError,StarNameException,GCPD_No_Data)
+
+def system_data(ph,target,rem,index=None,stream=False):
+    """ Data of target in photometric system ph as printed by main,
+    with query errors reported as comments. Given a
+    GCPD_availability_index, systems without data are not queried.
+    With stream, the GCPD_measurements are returned instead.
+    """
+    cl=PHOTOMETRY_classes[ph]
+    try:
+        if index is not None and not index.has_data(target,ph,rem):
+            raise GCPD_No_Data
+        if stream:
+            return cl().measurements(target,rem,references=True)
+        return cl().print_data(target,rem)
+    except unit_errors,e:
+        return unit_message(ph,target,e)
+
+parse_sections=(GCPD_parser.DATA,GCPD_parser.REFERENCES)
+
+def system_query(ph,target,rem,index=None,stream=False):
+    """ The first half of system_data: a (ph, target, rem, key, body,
+    stream, vectorized) task for parse_unit with the response body of
+    the query, or the message system_data reports. key is the
+    gcpd_cache key of the query, None if the body is from gcpd_mirror.
+    """
+    cl=PHOTOMETRY_classes[ph]
+    try:
+        if index is not None and not index.has_data(target,ph,rem):
+            raise GCPD_No_Data
+        d=cl().query_params(target,rem,parse_sections)
+        key,body=None,None
+        if gcpd_mirror is not None:
+            body=gcpd_mirror.get(d['ident'],cl.system_string,rem)
+        if body is None:
+            body=gcpd_retry.call(read_query,cl.GCPD_action,d)
+            key=query_key(cl.GCPD_action,d)
+        return ph,target,rem,key,body,stream,gcpd_vectorized
+    except unit_errors,e:
+        return unit_message(ph,target,e)
+
+def parse_unit(item):
+    """ The second half of system_data, run in a worker process of
+    parse_map. For a (unit, task) item, task from system_query,
+    returns the unit, its result and the cache key of a query found
+    to have no data, else None.
+    """
+    unit,task=item
+    if isinstance(task,str):
+        return unit,task,None
+    ph,target,rem,key,body,stream,vectorized=task
+    global gcpd_vectorized
+    gcpd_vectorized=vectorized
+    cl=PHOTOMETRY_classes[ph]()
+    h=GCPD_parser(sections=parse_sections)
+    try:
+        h.feed(body)
+        m=cl.parsed_measurements(h,target,rem)
+    except GCPD_No_Data,e:
+        return unit,unit_message(ph,target,e),key
+    if stream:
+        return unit,m,None
+    return unit,cl.format_data(m),None
+
+def parse_map(units,jobs=4,workers=4,ordered=True,index=None,stream=False):
+    """ (unit, system_data) for each (system, target, rem) unit of
+    units, the bodies fetched by jobs threads and parsed by workers
+    processes. At most 2*jobs bodies are being fetched and 2*workers
+    parsed at once, so units may be any length. Units that are
+    messages are passed on as their own result.
+    """
+    # forked before the fetching threads start
+    pool=multiprocessing.Pool(workers)
+    def query(u):
+        if isinstance(u,str):
+            return u,u
+        return u,system_query(*u,index=index,stream=stream)
+    try:
+        tasks=thread_map(query,units,jobs,ordered)
+        for u,result,key in pool_map(pool,parse_unit,tasks,2*workers,
+                                     ordered):
+            if key is not None and gcpd_cache is not None:
+                gcpd_cache.put_negative(key)
+            yield u,result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def pool_map(pool, func, iterable, window, ordered=True):
+    """ thread_map with the processes of a multiprocessing.Pool: func
+    must be a module level function, the items and results picklable.
+    At most window items are in flight.
+
+    The items are only taken from iterable as results are yielded, so
+    a slow consumer holds back the producer of iterable.
+    """
+    items=iter(iterable)
+    pending=collections.deque()
+    while True:
+        while items is not None and len(pending)<window:
+            try:
+                item=items.next()
+            except StopIteration:
+                items=None
+                break
+            pending.append(pool.apply_async(func,(item,)))
+        if not pending:
+            break
+        if ordered:
+            result=pending.popleft()
+        else:
+            while True:
+                ready=[r for r in pending if r.ready()]
+                if ready:
+                    break
+                pending[0].wait(0.01)
+            result=ready[0]
+            pending.remove(result)
+        # a wait with a timeout lets KeyboardInterrupt through
+        while not result.ready():
+            result.wait(1.0)
+        yield result.get()
+
+def all_system_units(targets,index,jobs=4):
+    """ Yield a (system, target, rem) unit for every supported system
+    with data for each (target, rem) of targets, according to the
+    GCPD_availability_index. The systems of jobs targets are looked
+    up at once. A target whose systems cannot be found yields a
+    message instead.
+    """
+    def discover(tr):
+        target,rem=tr
+        try:
+            return target,rem,index.available(target,rem)
+        except IOError,k:
+            return target,rem,io_error_message(k)
+    for target,rem,systems in thread_map(discover,targets,jobs):
+        if isinstance(systems,str):
+            yield systems
+        elif not systems:
+            yield "# No supported photosystems for star %s "% target
+        else:
+            for ph in systems:
+                yield ph,target,rem
+
+class GCPD_future:
+    """ Result of a query of AsyncGCPDClient, set in the thread of its
+    event loop. result() waits for it in any thread; callbacks added
+    with add_done_callback are called with the future once it is set,
+    in the loop thread, so they must not block.
+    """
+    def __init__(self):
+        self.event=threading.Event()
+        self.lock=threading.Lock()
+        self.callbacks=[]
+        self.value=None
+        self.error=None     # sys.exc_info() of a failed query
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """ The result, waiting at most timeout seconds for it.
+        Raises the exception of a failed query.
+        """
+        if not self.event.wait(timeout):
+            raise socket.timeout('query not done')
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def set_result(self, value):
+        self.value=value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error=error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.event.set()
+            callbacks,self.callbacks=self.callbacks,[]
+        for func in callbacks:
+            self.call(func)
+
+    def call(self, func):
+        try:
+            func(self)
+        except Exception:
+            # a broken callback must not stop the event loop
+            traceback.print_exc()
+
+    def add_done_callback(self, func):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(func)
+                return
+        self.call(func)
+
+    def run(self, func, *args):
+        """ Sets the result of func(*args), or that of the GCPD_future
+        it returns.
+        """
+        try:
+            value=func(*args)
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+        if isinstance(value, GCPD_future):
+            value.add_done_callback(self.copy)
+        else:
+            self.set_result(value)
+
+    def copy(self, future):
+        if future.error is not None:
+            self.set_exception(future.error)
+        else:
+            self.set_result(future.value)
+
+    def then(self, func, *args):
+        """ GCPD_future of func(result, *args) """
+        future=GCPD_future()
+        def done(f):
+            if f.error is not None:
+                future.set_exception(f.error)
+            else:
+                future.run(func, f.value, *args)
+        self.add_done_callback(done)
+        return future
+
+class _GCPD_async_query:
+    """ A GCPD query of AsyncGCPDClient: the response is taken from
+    gcpd_cache or requested, and fed as it arrives to a new parser
+    from make_parser for each try. The future is set to
+    result(parser) once it is all read, or to the error of the last
+    try, see gcpd_retry.
+    """
+    def __init__(self, client, future, action_url, params, post,
+                 make_parser, result):
+        self.client=client
+        self.future=future
+        self.action_url=action_url
+        self.params=params
+        self.url,self.data=query_request(action_url, params, post)
+        self.key=None
+        if gcpd_cache is not None:
+            self.key=query_key(action_url, params)
+        self.make_parser=make_parser
+        self.result=result
+        self.start=time.time()
+        self.attempt=0
+
+    def begin(self):
+        self.h=self.make_parser()
+        self.pending=''
+        self.chunks=[]
+        try:
+            body=self.key and gcpd_cache.get(self.key)
+            if body is not None:
+                self.h.feed(body)
+                self.future.set_result(self.result(self.h))
+                return
+        except Exception:
+            self.fail(sys.exc_info())
+            return
+        self.client.waiting.append(self)
+
+    def feed(self, chunk):
+        """ Parses a chunk of the response, False once the rest is
+        not wanted.
+        """
+        if self.key is not None:
+            self.chunks.append(chunk)
+        if not self.h.done:
+            self.pending=feed_chunk(self.h, self.pending, chunk)
+        return not self.h.done or self.key is not None
+
+    def finish(self, headers):
+        try:
+            self.h.feed(self.pending)
+            if self.key is not None:
+                gcpd_cache.put(self.key, ''.join(self.chunks),
+                               headers.getheader('etag'),
+                               headers.getheader('last-modified'),
+                               self.url, self.data)
+            value=self.result(self.h)
+        except Exception:
+            self.fail(sys.exc_info())
+            return
+        self.future.set_result(value)
+
+    def fail(self, error):
+        if isinstance(error[1], GCPD_No_Data):
+            record_no_data(self.action_url, self.params)
+        else:
+            delay=gcpd_retry.delay(error[1], self.attempt, self.start)
+            if delay is not None:
+                self.attempt+=1
+                self.client.later(delay, self.begin, self)
+                return
+        self.future.set_exception(query_error(error))
+
+class _GCPD_async_request(asyncore.dispatcher):
+    """ The HTTP/1.0 request of a _GCPD_async_query on a non-blocking
+    socket of the AsyncGCPDClient's map. The body of the response is
+    fed to the query as it arrives. Redirects are not followed.
+    """
+    max_header=65536
+    def __init__(self, client, query):
+        asyncore.dispatcher.__init__(self, map=client.map)
+        self.client=client
+        self.query=query
+        scheme,netloc,path,q,fragment=urlparse.urlsplit(query.url)
+        if q:
+            path=path+'?'+q
+        lines=['%s %s HTTP/1.0' % (query.data is None and 'GET' or 'POST',
+                                   path or '/'),
+               'Host: '+netloc]
+        if query.data is not None:
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+            lines.append('Content-Length: %d' % len(query.data))
+        self.out='\r\n'.join(lines)+'\r\n\r\n'+(query.data or '')
+        self.header=''
+        self.headers=None
+        self.length=None
+        self.received=0
+        self.start=self.active=time.time()
+        self.latency=None
+        self.finished=False
+        host,port=urllib.splitport(netloc)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(client.address(host, int(port or 80)))
+        except:
+            self.close()
+            raise
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self.out)
+
+    def handle_write(self):
+        sent=self.send(self.out)
+        self.out=self.out[sent:]
+        self.active=time.time()
+
+    def handle_read(self):
+        data=self.recv(65536)
+        if not data:
+            return
+        self.active=time.time()
+        if self.headers is None:
+            self.header+=data
+            i=self.header.find('\r\n\r\n')
+            if i<0:
+                if len(self.header)>self.max_header:
+                    raise httplib.LineTooLong('header')
+                return
+            data=self.header[i+4:]
+            self.read_header(self.header[:i+2])
+        self.received+=len(data)
+        if data and not self.query.feed(data):
+            self.done()  # the rest is not wanted
+        elif self.length is not None and self.received>=self.length:
+            self.done()
+
+    def read_header(self, text):
+        self.latency=time.time()-self.start
+        line,text=text.split('\r\n', 1)
+        fields=line.split(None, 2)
+        if len(fields)<2 or not fields[0].startswith('HTTP/'):
+            raise httplib.BadStatusLine(line)
+        try:
+            status=int(fields[1])
+        except ValueError:
+            raise httplib.BadStatusLine(line)
+        self.headers=httplib.HTTPMessage(cStringIO.StringIO(text))
+        if status!=200:
+            raise IOError('http error', status, fields[2:] and fields[2] or '',
+                          self.headers)
+        length=self.headers.getheader('content-length')
+        if length and length.isdigit():
+            self.length=int(length)
+
+    def handle_close(self):
+        err=self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        if self.headers is None:
+            raise httplib.BadStatusLine(self.header)
+        if self.length is not None and self.received<self.length:
+            raise httplib.IncompleteRead('', self.length-self.received)
+        self.done()
+
+    def handle_error(self):
+        self.done(sys.exc_info())
+
+    def check_timeout(self, now):
+        if now-self.active>self.client.timeout:
+            self.done((socket.timeout, socket.timeout('timed out'), None))
+        elif (self.client.deadline and
+              now-self.start>self.client.deadline):
+            self.done((socket.timeout,
+                       socket.timeout('request deadline passed'), None))
+
+    def done(self, error=None):
+        if self.finished:
+            return
+        self.finished=True
+        self.close()
+        self.client.finished(self, error)
+
+class AsyncGCPDClient:
+    """ Client running any number of GCPD queries at once on one
+    asyncore event loop, with no thread per query. fetch, measurements
+    and system_list return a GCPD_future at once. The queries use
+    gcpd_mirror, gcpd_cache and gcpd_retry, and the parsers and
+    derivations of the blocking functions, which work alongside.
+    Identical queries in flight share one request.
+
+    At most max_connections requests are open at once, fewer when
+    GCPD gets slow or fails, see GCPD_aimd_limiter. With rate, at
+    most rate requests a second are sent to a host. A request with
+    no data for timeout seconds fails, as does one taking more than
+    deadline seconds in all.
+
+    The loop runs in the thread calling run(), or in a thread of its
+    own after start(), until stop(). The methods may be called from
+    any thread, and a blocking caller just waits for the results.
+    Queries not done when the loop stops, and queries submitted after
+    stop(), fail with IOError. A stopped client cannot be run again.
+
+    >>> c=AsyncGCPDClient()
+    >>> c.start()
+    >>> c.submit(lambda x: 2*x, 21).result(10)
+    42
+    >>> c.stop()
+    >>> c.submit(len, 'x').result(10)
+    Traceback (most recent call last):
+    IOError: AsyncGCPDClient stopped
+    """
+    poll_interval=0.05  # seconds before queries of other threads start
+    def __init__(self, max_connections=100, timeout=60, rate=None,
+                 deadline=300):
+        self.map={}
+        self.timeout=timeout
+        self.deadline=deadline
+        self.rate=rate
+        self.limiter=GCPD_aimd_limiter(max_connections)
+        self.buckets={}
+        self.calls=collections.deque()    # (future, func, args) to run
+        self.waiting=collections.deque()  # queries waiting to be sent
+        self.timers=[]                    # heap of (time, n, func, query)
+        self.timer_count=itertools.count()
+        self.inflight={}
+        self.addresses={}
+        self.running=False
+        self.stopped=False  # set once stop() begins, submit fails then
+        self.lock=threading.Lock()
+        self.thread=None
+
+    def fetch(self, target, system, rem='', sections=GCPD_parser.all_sections):
+        """ GCPD_future of the GCPD_parser of target in system, like
+        fetch_data of its GCPD_Photometry class.
+        """
+        return self.submit(self.query_system, target, system, rem,
+                           tuple(sections))
+
+    def measurements(self, target, system, rem='', references=False):
+        """ GCPD_future of the GCPD_measurements of target in system """
+        return self.submit(self.query_measurements, target, system, rem,
+                           references)
+
+    def system_list(self, target, rem=''):
+        """ GCPD_future of the system list of target, as given by
+        GCPD_system_list.
+        """
+        return self.submit(self.query_system_list, target)
+
+    def submit(self, func, *args):
+        """ GCPD_future of func(*args), called in the loop thread """
+        future=GCPD_future()
+        with self.lock:
+            if not self.stopped:
+                self.calls.append((future, func, args))
+                return future
+        future.set_exception(self.stopped_error())
+        return future
+
+    def query_system(self, target, system, rem, sections):
+        cl=PHOTOMETRY_classes[translate_photo_name(system)]
+        d=cl().query_params(target, rem, sections)
+        body=None
+        if gcpd_mirror is not None:
+            body=gcpd_mirror.get(d['ident'], cl.system_string, rem)
+        if body is not None:
+            h=GCPD_parser(sections=sections)
+            h.feed(body)
+            return h
+        return self.query((query_key(cl.GCPD_action, d), sections),
+                          cl.GCPD_action, d, False,
+                          lambda: GCPD_parser(sections=sections),
+                          lambda h: h)
+
+    def query_measurements(self, target, system, rem, references):
+        cl=PHOTOMETRY_classes[translate_photo_name(system)]
+        sections=[GCPD_parser.DATA]
+        if references:
+            sections.append(GCPD_parser.REFERENCES)
+        return self.query_system(target, system, rem, tuple(sections)).then(
+            cl().parsed_measurements, target, rem)
+
+    def query_system_list(self, target):
+        params=system_list_params(target)
+        future=self.query(('POST', query_key(GCPD_index_action, params)),
+                          GCPD_index_action, params, True,
+                          GCPD_table_parser,
+                          lambda h: parsed_system_list(h, params))
+        return future.then(list)
+
+    def query(self, key, action_url, params, post, make_parser, result):
+        """ GCPD_future of result(parser) for a query, shared by
+        queries with an equal key while it is in flight.
+        """
+        if key in self.inflight:
+            return self.inflight[key]
+        future=self.inflight[key]=GCPD_future()
+        future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        _GCPD_async_query(self, future, action_url, params, post,
+                          make_parser, result).begin()
+        return future
+
+    def later(self, delay, func, query=None):
+        """ Calls func in the loop after delay seconds, for query """
+        heapq.heappush(self.timers,
+                       (time.time()+delay, next(self.timer_count), func, query))
+
+    def address(self, host, port):
+        if (host, port) not in self.addresses:
+            # resolved once, blocking the loop
+            self.addresses[host, port]=socket.gethostbyname(host), port
+        return self.addresses[host, port]
+
+    def send_waiting(self):
+        while self.waiting and self.limiter.try_acquire():
+            query=self.waiting.popleft()
+            wait=0
+            if self.rate:
+                host=urlparse.urlsplit(query.url)[1]
+                if host not in self.buckets:
+                    self.buckets[host]=GCPD_token_bucket(self.rate)
+                wait=self.buckets[host].reserve()
+            if wait>0:
+                self.later(wait, lambda query=query: self.send(query), query)
+            else:
+                self.send(query)
+
+    def send(self, query):
+        try:
+            _GCPD_async_request(self, query)
+        except Exception:
+            self.limiter.release(0., True)
+            query.fail(sys.exc_info())
+
+    def finished(self, request, error):
+        latency=request.latency
+        if latency is None:
+            latency=time.time()-request.start
+        self.limiter.release(latency,
+                             error is not None and transient_error(error[1]))
+        if error is None:
+            request.query.finish(request.headers)
+        else:
+            request.query.fail(error)
+
+    def run(self):
+        """ Runs the event loop until stop() """
+        with self.lock:
+            # a stop() before the loop starts still ends it
+            self.running=not self.stopped
+        try:
+            while self.running:
+                self.step()
+        finally:
+            self.running=False
+            self.cancel()
+
+    def stopped_error(self):
+        """ sys.exc_info() of the IOError of queries failed by stop() """
+        try:
+            raise IOError('AsyncGCPDClient stopped')
+        except IOError:
+            return sys.exc_info()
+
+    def cancel(self):
+        """ Fails all queries not done with IOError, and the queries
+        submitted from now on.
+        """
+        error=self.stopped_error()
+        with self.lock:
+            self.stopped=True
+            calls=list(self.calls)
+            self.calls.clear()
+        for request in self.map.values():
+            request.done(error)
+        futures=[future for future,func,args in calls]
+        futures.extend([query.future for query in self.waiting])
+        futures.extend([query.future for t,n,func,query in self.timers
+                        if query is not None])
+        futures.extend(self.inflight.values())
+        self.waiting.clear()
+        del self.timers[:]
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def step(self):
+        while self.calls:
+            future,func,args=self.calls.popleft()
+            future.run(func, *args)
+        now=time.time()
+        while self.timers and self.timers[0][0]<=now:
+            heapq.heappop(self.timers)[2]()
+        self.send_waiting()
+        for request in self.map.values():
+            request.check_timeout(now)
+        timeout=self.poll_interval
+        if self.timers:
+            timeout=max(0, min(timeout, self.timers[0][0]-now))
+        if self.map:
+            asyncore.loop(timeout, True, self.map, 1)
+        else:
+            time.sleep(timeout)
+
+    def start(self):
+        """ Runs the event loop in a daemon thread """
+        self.thread=threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stops the loop after its current step; queries not done by
+        then fail with IOError, as do queries submitted from now on.
+        """
+        with self.lock:
+            self.stopped=True
+        self.running=False
+        if (self.thread is not None and
+            self.thread is not threading.current_thread()):
+            self.thread.join()
+            self.thread=None
+
+def read_targets(f,rem=''):
+    """ Read (target, rem) pairs from a targets file, one target per line.
+    The rem code may follow the target after a tab or a comma, rem is
+    used for lines without one. Blank lines and lines starting with
+    # are skipped. Lines are read lazily, so f may be any length.
+
+    >>> list(read_targets(['HD17713, AB', '# comment', '', 'HIP1'], 'A'))
+    [('HD17713', 'AB'), ('HIP1', 'A')]
+    """
+    for line in f:
+        line=line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields=re.split('[\t,]', line, 1)
+        if len(fields)>1:
+            yield fields[0].strip(), fields[1].strip()
+        else:
+            yield line, rem
+
 def printhelp(fd=sys.stderr):
     try :
         scriptname=__file__
@@ -966,6 +4081,121 @@ def printhelp(fd=sys.stderr):
     To get the list of photometry systems for a given star, call
 
     %(scriptname)s --target targetname --systemlist
+
+    Several --system options are queried concurrently, --jobs N sets
+    how many queries run at once (default 4, 1 queries one after the
+    other). Output is printed in the order of the --system options,
+    unless --unordered is given, then each system is printed as soon
+    as it arrives.
+
+    To query many stars in one run, call
+
+    %(scriptname)s --targets-file filename --system photometry_system_name
+
+    with one target per line, optionally followed by a rem code after a
+    tab or a comma. Use - as filename to read the targets from stdin.
+
+    With --skip-unavailable, the list of systems with data is fetched
+    once for each star and only those systems are queried.
+
+    To get the data of a star in all supported systems that have data
+    for it, call
+
+    %(scriptname)s --target targetname --all-systems
+
+    The systems are queried concurrently and each is printed as soon as
+    it arrives. --all-systems works with --targets-file as well.
+
+    With --cache filename, responses are kept in an SQLite file and
+    identical queries are answered from it. --cache-ttl sets how many
+    days an entry stays valid (default 30), --cache-size the maximal
+    size in MB (default 512), least recently used entries go first.
+    Queries without data are cached too, for --cache-negative-ttl days
+    (default 7).
+
+    With --stream, every magnitude is printed as a tab separated line
+
+    M   target   system   band   magnitude
+
+    and every reference as
+
+    R   target   system   author   journal   title   bibcode URL
+
+    as soon as the data of a system arrives. Messages start with #.
+
+    --format jsonl|csv|npz writes the magnitudes for other programs:
+    JSON Lines, one object per magnitude or reference; CSV with a
+    target,system,band,value header, without references; or a NumPy
+    .npz file with one array per column, which needs numpy. Messages
+    go to stderr. --output filename writes to a file instead of stdout,
+    npz needs it.
+
+    With --store filename, the data is saved in an SQLite result store,
+    one entry per star, system and rem code; storing a star again
+    replaces its data. Without --format only messages are printed.
+    The stored data is read back with
+
+    %(scriptname)s --from-store filename [--target targetname]
+                   [--targets-file filename] [--system name] [--band band]
+
+    which writes every stored star, system and band unless they are
+    restricted with these options, in the --format chosen. Stars are
+    matched by their GCPD number, so HD1 and HDE1 are the same star.
+
+    %(scriptname)s --from-store filename --system name --system name
+                   --stars-with-data
+
+    lists the stars with data in all of the systems.
+
+    For sweeps over many stars, the responses can be fetched once into
+    a local mirror with
+
+    %(scriptname)s --harvest directory --targets-file filename
+                   [--system name]
+
+    for the given systems, or all supported systems. Harvesting again
+    adds to the mirror and replaces stars fetched before. With
+    --mirror directory, queries are answered from the mirror when it
+    has them, and with --offline as well, queries it does not have are
+    reported as errors instead of being sent to GCPD.
+
+    With --refresh, the entries of the --cache older than --refresh-age
+    days (default 7) and all entries of the --mirror are checked
+    against GCPD, with conditional requests where GCPD supports them.
+    Only entries whose content changed are rewritten, each is reported.
+
+    Stars may be given by HD, HDE, SAO, HIP or PPM number, or by any
+    name in the alias table. The table knows the HR and catalogue
+    numbers, proper names and Bayer and Flamsteed designations of a
+    few bright stars; --aliases filename adds the stars of a table
+    with one star per line and its names separated by tabs, the first
+    an HD, SAO, HIP or PPM number. With --unique, a star given under
+    several names is only queried once; every star of the run is
+    remembered for this, so it is best left out of very long runs.
+
+    Queries time out after --timeout seconds (default 60) without an
+    answer, or --deadline seconds (default 300) in all. Queries
+    failing with a timeout, a lost connection or a server error are
+    tried again up to --retries times (default 4), after a random
+    wait growing exponentially. At most --rate requests per second
+    (default 10, 0 for no limit) are sent to a host, and when GCPD
+    gets slow or fails, fewer than --jobs are sent at once.
+
+    With --parse-workers number, the responses fetched by the --jobs
+    threads are parsed by that many processes instead, which is
+    faster for long --targets-file runs on machines with many cores.
+
+    With --journal filename, the units of a run with --output and
+    --format, or with --store, are recorded in an SQLite work table
+    as they finish, done or failed, every 100 units together with
+    the length of the output written so far. If the run stops, the
+    same command with --resume cuts the output back to the last
+    record, skips the units done and runs again those that failed
+    fewer than --max-attempts times (default 3). Without --resume the
+    journal starts empty.
+
+    With --numpy, the magnitudes are derived with numpy array
+    operations, which is faster for stars with many measurements.
     
     To run the test, call %(scriptname)s --test. Net connection should be up. It is silent
     if no failures are found. Test failures are sometimes due to changing data in database.
@@ -980,15 +4210,41 @@ class Usage(Exception):
         self.msg = msg
 
 def main(argv=None):
+    global gcpd_session, gcpd_cache, gcpd_vectorized, gcpd_mirror
     rem = ''
     if argv is None:
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help","target=","system=","test","systemlist",'rem='])
+            opts, args = getopt.getopt(argv[1:], "h", ["help","target=","system=","test","systemlist",'rem=',
+                                                       'jobs=','unordered','targets-file=',
+                                                       'cache=','cache-ttl=','cache-size=',
+                                                       'cache-negative-ttl=','skip-unavailable',
+                                                       'all-systems','numpy','stream',
+                                                       'format=','output=','store=',
+                                                       'from-store=','band=',
+                                                       'stars-with-data','mirror=',
+                                                       'offline','harvest=','refresh',
+                                                       'refresh-age=','aliases=',
+                                                       'timeout=','retries=','rate=',
+                                                       'parse-workers=','journal=',
+                                                       'resume','max-attempts=',
+                                                       'deadline=','unique'])
         except getopt.error, msg:
             raise Usage(msg)
         target,photosystem,systemlist=None,[],None
+        jobs,ordered=4,True
+        targets_file=None
+        cache,cache_ttl,cache_size,cache_negative_ttl=None,30.,512.,7.
+        index,all_systems=None,False
+        output_format,output=None,None
+        store,from_store,bands,stars_with_data=None,None,None,False
+        mirror,offline,harvest=None,False,None
+        refresh,refresh_age=False,7.
+        timeout,rate,deadline=60.,10.,300.
+        parse_workers=0
+        journal,resume,max_attempts=None,False,3
+        unique=False
         for opt,val in opts:
             if opt in ['-h', '--help']:
                 raise Usage('')
@@ -1004,23 +4260,276 @@ def main(argv=None):
                 sys.exit(0)
             if opt in ['--systemlist']:
                 systemlist=True
-
-        if target and photosystem:
-            for ph in photosystem:
-                if ph in PHOTOMETRY_classes:
-                    cl=PHOTOMETRY_classes[ph]
+            if opt=='--jobs':
+                try:
+                    jobs=int(val)
+                except ValueError:
+                    raise Usage('--jobs needs a number')
+            if opt in ['--parse-workers','--max-attempts']:
+                try:
+                    if opt=='--parse-workers':
+                        parse_workers=int(val)
+                    else:
+                        max_attempts=int(val)
+                except ValueError:
+                    raise Usage('%s needs a number' % opt)
+            if opt=='--journal':
+                journal=val
+            if opt=='--resume':
+                resume=True
+            if opt=='--unordered':
+                ordered=False
+            if opt=='--targets-file':
+                targets_file=val
+            if opt=='--cache':
+                cache=val
+            if opt=='--skip-unavailable':
+                index=GCPD_availability_index()
+            if opt=='--all-systems':
+                all_systems=True
+            if opt=='--stream':
+                output_format='text'
+            if opt=='--format':
+                if val not in output_formats:
+                    raise Usage('unknown format %s' % val)
+                if val=='npz' and numpy is None:
+                    raise Usage('--format npz needs numpy')
+                output_format=val
+            if opt=='--output':
+                output=val
+            if opt=='--store':
+                store=val
+            if opt=='--from-store':
+                from_store=val
+            if opt=='--band':
+                bands=(bands or [])+[val]
+            if opt=='--stars-with-data':
+                stars_with_data=True
+            if opt=='--mirror':
+                mirror=val
+            if opt=='--offline':
+                offline=True
+            if opt=='--harvest':
+                harvest=val
+            if opt=='--refresh':
+                refresh=True
+            if opt=='--unique':
+                unique=True
+            if opt=='--aliases':
+                try:
+                    f=open(val)
                     try:
-                        print cl().print_data(target,rem)
-                    except IOError,k:
-                        print "# IOEror ", k[0],' --- ' , k[1]
-                    except StarNameException,ex:
-                        print "# star %s not found"% target
-                    except GCPD_No_Data,ex:
-                        print "# No data for star %s in photosystem %s"% (target,photosystem)
-                
+                        gcpd_resolver.load(f)
+                    finally:
+                        f.close()
+                except (IOError, ValueError),k:
+                    raise Usage('cannot load aliases %s: %s' % (val, k))
+            if opt=='--numpy':
+                if numpy is None:
+                    raise Usage('--numpy needs numpy')
+                gcpd_vectorized=True
+            if opt in ['--cache-ttl','--cache-size','--cache-negative-ttl',
+                       '--refresh-age','--timeout','--retries','--rate',
+                       '--deadline']:
+                try:
+                    if opt=='--cache-ttl':
+                        cache_ttl=float(val)
+                    elif opt=='--refresh-age':
+                        refresh_age=float(val)
+                    elif opt=='--timeout':
+                        timeout=float(val)
+                    elif opt=='--deadline':
+                        deadline=float(val)
+                    elif opt=='--retries':
+                        gcpd_retry.retries=int(val)
+                    elif opt=='--rate':
+                        rate=float(val)
+                    elif opt=='--cache-size':
+                        cache_size=float(val)
+                    else:
+                        cache_negative_ttl=float(val)
+                except ValueError:
+                    raise Usage('%s needs a number' % opt)
+
+        gcpd_session=GCPD_session(max(jobs,1), timeout or None, rate or None,
+                                  deadline or None)
+        if cache:
+            gcpd_cache=GCPD_cache(cache, cache_ttl*86400, int(cache_size*2**20),
+                                  cache_negative_ttl*86400)
+        if offline and not mirror:
+            raise Usage('--offline needs --mirror')
+        if mirror:
+            try:
+                gcpd_mirror=GCPD_mirror(mirror, offline)
+            except IOError,k:
+                raise Usage('cannot open mirror %s: %s' % (mirror, k))
+
+        def output_writer(offset=None):
+            # with offset, the output is appended to its first offset bytes
+            if output:
+                if offset is None:
+                    f=open(output,'wb',2**20)
+                else:
+                    f=open(output,'ab',2**20)
+                    f.truncate(offset)
+                    f.seek(0,2)
+                writer=output_formats[output_format or 'text'](f)
+            elif output_format=='npz':
+                raise Usage('--format npz needs --output')
+            else:
+                writer=output_formats[output_format or 'text'](sys.stdout)
+                offset=None
+            if not offset:
+                writer.start()
+            return writer
+
+        def read_all_targets():
+            targets=[]
+            if target:
+                targets=[(target,rem)]
+            if targets_file=='-':
+                targets=itertools.chain(targets, read_targets(sys.stdin,rem))
+            elif targets_file:
+                try:
+                    f=open(targets_file)
+                except IOError,k:
+                    raise Usage('cannot open targets file %s: %s'
+                                % (targets_file, k))
+                def file_targets():
+                    # targets are read lazily, the file is closed at its end
+                    with f:
+                        for t in read_targets(f,rem):
+                            yield t
+                targets=itertools.chain(targets, file_targets())
+            if not unique:
+                return targets
+            def duplicate(target, rem, first):
+                print >>sys.stderr, '# %s is the same star as %s' % (target,
+                                                                     first)
+            return unique_targets(targets, duplicate)
+
+        if refresh:
+            if not (cache or mirror):
+                raise Usage('--refresh needs --cache or --mirror')
+            messages=[]
+            if cache:
+                messages=gcpd_cache.refresh(refresh_age*86400, jobs)
+            if mirror:
+                messages=itertools.chain(messages, refresh_mirror(mirror, jobs))
+            for r in messages:
+                print r
+                sys.stdout.flush()
+
+        elif harvest and (target or targets_file):
+            photosystem=[ph for ph in photosystem if ph in PHOTOMETRY_classes]
+            units=((ph,t,r) for t,r in read_all_targets()
+                   for ph in photosystem or supported_systems)
+            for r in harvest_mirror(harvest, units, jobs):
+                print r
+                sys.stdout.flush()
+
+        elif from_store:
+            photosystem=[ph for ph in photosystem if ph in PHOTOMETRY_classes]
+            s=GCPD_store(from_store)
+            if stars_with_data:
+                if not photosystem:
+                    raise Usage('--stars-with-data needs --system')
+                for t in s.stars_with_data(photosystem):
+                    print t
+            else:
+                targets=None
+                if target or targets_file:
+                    targets=[t for t,r in read_all_targets()]
+                writer=output_writer()
+                for m in s.measurements(targets, photosystem or None, bands):
+                    writer.write(m)
+                writer.close()
+                if output:
+                    writer.f.close()
+            s.close()
+
+        elif (target or targets_file) and (photosystem or all_systems):
+            photosystem=[ph for ph in photosystem if ph in PHOTOMETRY_classes]
+            targets=read_all_targets()
+            if all_systems:
+                index=index or GCPD_availability_index()
+                units=all_system_units(targets,index,jobs)
+                ordered=False
+            else:
+                units=((ph,t,r) for t,r in targets for ph in photosystem)
+            if journal:
+                if not (output and output_format or store):
+                    raise Usage('--journal needs --output and --format, '
+                                'or --store')
+                if output_format=='npz':
+                    raise Usage('--journal cannot append to npz output')
+                journal=GCPD_journal(journal, resume, max_attempts)
+                all_units=units
+                units=(u for u in all_units
+                       if isinstance(u,str) or journal.wanted(u))
+            elif resume:
+                raise Usage('--resume needs --journal')
+            def unit_data(u):
+                if isinstance(u,str):
+                    return u,u
+                return u,system_data(*u,index=index,
+                                     stream=bool(output_format or store))
+            def results():
+                if parse_workers>0:
+                    return parse_map(units, jobs, parse_workers, ordered,
+                                     index, bool(output_format or store))
+                return thread_map(unit_data, units, jobs, ordered)
+            if output_format is None and store is None:
+                for u,r in results():
+                    print r
+                    sys.stdout.flush()
+            else:
+                writer=None
+                if output_format:
+                    writer=output_writer(journal and journal.offset)
+                if store:
+                    store=GCPD_store(store)
+                def checkpoint():
+                    # the output of the recorded units first, then the journal
+                    offset=None
+                    if writer and output:
+                        writer.f.flush()
+                        os.fsync(writer.f.fileno())
+                        offset=writer.f.tell()
+                    if store:
+                        store.flush()
+                    journal.checkpoint(offset)
+                for u,r in results():
+                    if isinstance(r,GCPD_measurements):
+                        if store:
+                            store.put(r)
+                        if writer:
+                            writer.write(r)
+                    elif writer:
+                        writer.message(r)
+                    else:
+                        print r
+                        sys.stdout.flush()
+                    if journal and not isinstance(u,str):
+                        journal.record(u,r)
+                        if len(journal.pending)>=100:
+                            checkpoint()
+                if journal:
+                    checkpoint()
+                    counts=journal.counts()
+                    print >>sys.stderr, '# journal: %d units done, %d failed' % (
+                        counts.get('done',0), counts.get('failed',0))
+                    journal.close()
+                if store:
+                    store.close()
+                if writer:
+                    writer.close()
+                    if output:
+                        writer.f.close()
+
         elif systemlist and target:
             try:
-                l=GCPD_system_list(target)
+                l=GCPD_system_list(target,rem)
                 print "# The following photometric systems are supported for this star: ", 
                 print ", ".join(l)
             except GCPD_No_Data,ex: